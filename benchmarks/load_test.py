@@ -0,0 +1,137 @@
+"""
+Load test of the bot with many admins sending commands at the same time
+
+Synthetic room messages are fed into the message handler of the bot (bot.token_actions) concurrently, as if they
+arrived from several rooms at once. Replies go to a stubbed sender and the admin API is the fake Synapse used by the
+tests, so the whole pipeline from parsing a message to sending the reply runs without a homeserver.
+Run from the repository root:
+
+    python -m benchmarks.load_test --admins 50 --commands 20 --mix list=4,show=3,create=2,delete=1
+"""
+import argparse
+import asyncio
+import random
+import time
+from matrix_registration_bot import bot
+from benchmarks.run import percentile, report, setup_bot
+from tests.fake_synapse import FakeEvent, FakeRoom, FakeSynapse, make_token_table
+
+COMMANDS = ("list", "show", "create", "delete")
+
+
+def parse_mix(mix: str):
+    """
+    :param mix: Weights of the commands, e.g. "list=4,show=3,create=2,delete=1"
+    :return: A dictionary of command to weight
+    """
+    weights = {}
+    for entry in mix.split(","):
+        command, _, weight = entry.partition("=")
+        command = command.strip()
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"Unknown command {command}, use one of {', '.join(COMMANDS)}")
+        try:
+            weights[command] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"The weight of {command} must be a number, not {weight!r}")
+    if sum(weights.values()) <= 0:
+        raise argparse.ArgumentTypeError("At least one command needs a positive weight")
+    return weights
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps for a fixed interval"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - start - self.interval)
+
+
+def message_for(command, fake, rng):
+    """Builds the message of a command, show and delete pick a random existing token"""
+    if command in ("show", "delete"):
+        if not fake.tokens:
+            return "list"
+        return f"{command} {rng.choice(list(fake.tokens))}"
+    return command
+
+
+async def admin(number, args, fake, weights, durations, rng):
+    """Sends commands one after another, like an admin waiting for each reply before sending the next command"""
+    room = FakeRoom(f"!room{number % args.rooms}:example.com")
+    sender = f"@admin{number}:example.com"
+    commands, command_weights = list(weights), list(weights.values())
+    for _ in range(args.commands):
+        command = rng.choices(commands, command_weights)[0]
+        event = FakeEvent(message_for(command, fake, rng), sender=sender)
+        start = time.perf_counter()
+        await bot.token_actions(room, event)
+        durations[command].append(time.perf_counter() - start)
+        if args.think_time:
+            await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    fake = FakeSynapse(make_token_table(args.tokens), latency=args.latency, error_rate=args.error_rate,
+                       rate_limit_rate=args.rate_limit_rate)
+    replies = []
+
+    async def send(room_id, message):
+        if args.send_latency:
+            await asyncio.sleep(args.send_latency)
+        replies.append(len(message))
+
+    async with fake.server() as server:
+        base_url = str(server.make_url(""))
+        setup_bot(fake, base_url, send=send,
+                  environment={"RATE_LIMIT_ENABLED": "true" if args.rate_limit else "false"})
+        print(f"{args.admins} admins in {args.rooms} rooms sending {args.commands} commands each, fake Synapse with "
+              f"{args.tokens} tokens and {args.latency * 1000:.1f} ms latency")
+        durations = {command: [] for command in args.mix}
+        monitor = LoopLagMonitor(args.lag_interval)
+        monitor_task = asyncio.create_task(monitor.run())
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(admin(number, args, fake, args.mix, durations, random.Random(rng.random()))
+                                   for number in range(args.admins)))
+        finally:
+            total_time = time.perf_counter() - start
+            monitor_task.cancel()
+            await bot.api.close()
+    for command, command_durations in durations.items():
+        if command_durations:
+            report(f"command: {command}", command_durations, total_time)
+    all_durations = [duration for command_durations in durations.values() for duration in command_durations]
+    report("all commands", all_durations, total_time)
+    print(f"{len(replies)} replies, {sum(replies) / 1024:.1f} KiB")
+    if monitor.lags:
+        print(f"event loop lag p50 {percentile(monitor.lags, 50) * 1000:.2f} ms  "
+              f"p99 {percentile(monitor.lags, 99) * 1000:.2f} ms  max {max(monitor.lags) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the message handling of the bot against a fake Synapse")
+    parser.add_argument("--admins", type=int, default=20, help="Number of admins sending commands concurrently")
+    parser.add_argument("--rooms", type=int, default=5, help="Number of rooms the admins are spread over")
+    parser.add_argument("--commands", type=int, default=20, help="Commands sent by each admin")
+    parser.add_argument("--mix", type=parse_mix, default="list=4,show=3,create=2,delete=1",
+                        help="Weights of the commands, e.g. list=4,show=3,create=2,delete=1")
+    parser.add_argument("--think-time", type=float, default=0,
+                        help="Average pause of an admin between two commands in seconds")
+    parser.add_argument("--tokens", type=int, default=1000, help="Number of tokens on the fake homeserver")
+    parser.add_argument("--latency", type=float, default=0.001, help="Latency of each admin API request in seconds")
+    parser.add_argument("--send-latency", type=float, default=0, help="Latency of sending a reply in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Share of requests rate limited with a 429")
+    parser.add_argument("--rate-limit", action="store_true", help="Apply the command rate limit of the bot")
+    parser.add_argument("--lag-interval", type=float, default=0.01,
+                        help="Interval in seconds at which the event loop lag is sampled")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random workload")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,125 @@
+"""
+Offline benchmarks of the registration API client and the bot commands
+
+All requests go to a local fake of the Synapse admin API (see tests/fake_synapse.py), so no homeserver is needed.
+Run from the repository root:
+
+    python -m benchmarks.run --tokens 10000 --latency 0.002
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from matrix_registration_bot import bot
+from matrix_registration_bot.config import Config
+from matrix_registration_bot.registration_api import RegistrationAPI
+from tests.fake_synapse import FakeEvent, FakeRoom, FakeSynapse, make_token_table, setup_offline_bot
+
+
+def percentile(durations, p):
+    durations = sorted(durations)
+    return durations[min(len(durations) - 1, int(len(durations) * p / 100))]
+
+
+def report(name, durations, total_time, operations=None):
+    """
+    Prints throughput and latency percentiles of a benchmark
+
+    :param durations: Duration of each measured call in seconds
+    :param total_time: Wall time of the whole benchmark in seconds
+    :param operations: Number of operations done, defaults to the number of calls
+    """
+    if operations is None:
+        operations = len(durations)
+    print(f"{name:<32} {operations:>7} ops {operations / total_time:>10.1f} ops/s "
+          f"p50 {percentile(durations, 50) * 1000:>9.2f} ms  p99 {percentile(durations, 99) * 1000:>9.2f} ms")
+
+
+async def measure(name, coroutine_function, iterations: int, operations_per_call: int = 1):
+    durations = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        await coroutine_function()
+        durations.append(time.perf_counter() - call_start)
+    report(name, durations, time.perf_counter() - start, iterations * operations_per_call)
+
+
+async def benchmark_api(args, fake, base_url):
+    api = RegistrationAPI(base_url, api_token=fake.access_token, max_concurrency=args.concurrency, cache_ttl=0)
+    try:
+        await measure("list_tokens", api.list_tokens, args.iterations)
+        await measure("get_token", lambda: api.get_token("valid3"), args.iterations)
+        await measure("create_token", api.create_token, args.iterations)
+        await measure(f"create_tokens({args.batch})", lambda: api.create_tokens(args.batch), 1, args.batch)
+        api.cache_ttl = 60
+        await api.list_tokens()
+        await measure("get_token (token index)", lambda: api.get_token("valid3"), args.iterations)
+        api.cache_ttl = 0
+        await measure(f"delete_all_token({len(fake.tokens)})", api.delete_all_token, 1, len(fake.tokens))
+    finally:
+        await api.close()
+
+
+def setup_bot(fake, base_url, send=None, environment=None):
+    """
+    Sets the bot up against the fake admin API without connecting to Matrix
+
+    :param send: Coroutine function replacing the functions sending messages, by default replies are discarded
+    :param environment: Additional config values as environment variables
+    """
+    os.environ.update({"BOT_SERVER": base_url, "BOT_USERNAME": "registration-bot", "BOT_ACCESS_TOKEN": "unused",
+                       "API_BASE_URL": base_url, "API_TOKEN": fake.access_token, "API_CACHE_TTL": "0",
+                       "LOGGING_LEVEL": "ERROR", "CONFIG_PATH": os.devnull, "RATE_LIMIT_ENABLED": "false"})
+    os.environ.update(environment or {})
+    # Setting up the bot writes the simple-matrix-bot config to the working directory
+    working_directory = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        setup_offline_bot(Config(), send)
+    finally:
+        os.chdir(working_directory)
+
+
+async def benchmark_commands(args, fake, base_url):
+    """Drives the message handler of the bot with synthetic messages, replies are discarded"""
+    setup_bot(fake, base_url)
+    handler = bot.token_actions
+    room = FakeRoom("!benchmark:example.com")
+    try:
+        await measure("command: noise message", lambda: handler(room, FakeEvent("good morning")), args.iterations)
+        await measure("command: list", lambda: handler(room, FakeEvent("list")), args.iterations)
+        await measure("command: list --valid", lambda: handler(room, FakeEvent("list --valid")), args.iterations)
+        await measure("command: show", lambda: handler(room, FakeEvent("show valid3 valid7")), args.iterations)
+        await measure("command: create", lambda: handler(room, FakeEvent("create")), args.iterations)
+        await measure(f"command: create {args.batch}", lambda: handler(room, FakeEvent(f"create {args.batch}")), 1,
+                      args.batch)
+    finally:
+        await bot.api.close()
+
+
+async def main(args):
+    fake = FakeSynapse(make_token_table(args.tokens), latency=args.latency, error_rate=args.error_rate,
+                       rate_limit_rate=args.rate_limit_rate)
+    async with fake.server() as server:
+        base_url = str(server.make_url(""))
+        print(f"Fake Synapse with {args.tokens} tokens, {args.latency * 1000:.1f} ms latency, "
+              f"{args.error_rate:.0%} errors, {args.rate_limit_rate:.0%} rate limited")
+        await benchmark_api(args, fake, base_url)
+        fake.tokens = {token["token"]: token for token in make_token_table(args.tokens)}
+        if not args.skip_commands:
+            await benchmark_commands(args, fake, base_url)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the matrix-registration-bot against a fake Synapse")
+    parser.add_argument("--tokens", type=int, default=10000, help="Number of tokens on the fake homeserver")
+    parser.add_argument("--latency", type=float, default=0.001, help="Latency of each request in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Share of requests rate limited with a 429")
+    parser.add_argument("--iterations", type=int, default=50, help="Calls per benchmark")
+    parser.add_argument("--batch", type=int, default=200, help="Number of tokens created by batch benchmarks")
+    parser.add_argument("--concurrency", type=int, default=10, help="Maximum number of concurrent requests")
+    parser.add_argument("--skip-commands", action="store_true", help="Only benchmark the API client")
+    asyncio.run(main(parser.parse_args()))
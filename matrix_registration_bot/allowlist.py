@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import re
+import stat
+import tempfile
+
+# Backreferences (\1, (?P=name)) and conditionals ((?(1)...)) that refer to a group of the pattern
+GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+def compile_patterns(patterns):
+    """
+    Combines a set of regular expressions into one matcher
+
+    Patterns without special characters are looked up in a set, all others are combined into a single regex, so
+    matching does not get slower with each entry.
+
+    :param patterns: A set of compiled regular expressions
+    :return: A function returning True if a string fully matches any of the patterns
+    """
+    literals = set()
+    regexes = []
+    # Joining the patterns renumbers their groups, so patterns referring to a group are matched one by one
+    separate = []
+    for pattern in patterns:
+        if re.escape(pattern.pattern) == pattern.pattern:
+            literals.add(pattern.pattern)
+        elif GROUP_REFERENCE.search(pattern.pattern):
+            separate.append(pattern)
+        else:
+            regexes.append(pattern)
+    try:
+        combined = [re.compile("|".join(f"(?:{regex.pattern})" for regex in regexes))] if regexes else []
+    except re.error:
+        # Patterns that can not be combined, e.g. because they use the same group name, are matched one by one
+        combined = regexes
+    combined = combined + separate
+
+    def matches(value: str):
+        return value in literals or any(regex.fullmatch(value) for regex in combined)
+
+    return matches
+
+
+class AllowlistMatcher:
+    """
+    Checks if a user may use restricted commands, with the same rules as MessageMatch.is_from_allowed_user
+
+    The matchers are rebuilt when the allow- or blocklist of the config changes and the result is cached per user.
+    """
+
+    max_cache_size = 10000
+
+    def __init__(self, config):
+        self.config = config
+        self.allowlist = None
+        self.blocklist = None
+        self.allows = None
+        self.blocks = None
+        self.cache = {}
+
+    def rebuild(self):
+        # The simple-matrix-bot config replaces the sets on every change instead of modifying them
+        self.allowlist = self.config.allowlist
+        self.blocklist = self.config.blocklist
+        self.allows = compile_patterns(self.allowlist)
+        self.blocks = compile_patterns(self.blocklist)
+        self.cache = {}
+
+    def is_allowed(self, user_id: str):
+        if self.config.allowlist is not self.allowlist or self.config.blocklist is not self.blocklist:
+            self.rebuild()
+        try:
+            return self.cache[user_id]
+        except KeyError:
+            pass
+        # Without an explicit allowlist everyone is allowed
+        allowed = (len(self.allowlist) == 0 or self.allows(user_id)) and not self.blocks(user_id)
+        if len(self.cache) >= self.max_cache_size:
+            self.cache = {}
+        self.cache[user_id] = allowed
+        return allowed
+
+
+def save_atomically(config, path: str):
+    """
+    Saves the simple-matrix-bot config to a temporary file that replaces path, so a crash never leaves a partly
+    written config behind. The file keeps its permissions. Blocking, use it via asyncio.to_thread from the event loop.
+
+    :return: True if the file was written, False if it was already up to date
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+    os.close(fd)
+    try:
+        config.save_toml(temporary_path)
+        with open(temporary_path, 'rb') as new_file:
+            content = new_file.read()
+        try:
+            with open(path, 'rb') as old_file:
+                unchanged = old_file.read() == content
+                mode = stat.S_IMODE(os.fstat(old_file.fileno()).st_mode)
+        except FileNotFoundError:
+            unchanged = False
+            mode = None
+        if unchanged:
+            os.remove(temporary_path)
+            return False
+        if mode is not None:
+            # mkstemp creates the file readable by the owner only, the config may be managed by operators
+            os.chmod(temporary_path, mode)
+        os.replace(temporary_path, path)
+        return True
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class ConfigSaver:
+    """
+    Persists the simple-matrix-bot config in the background
+
+    Changes that are scheduled within delay seconds are written together and the file is written in a worker thread,
+    so the bot keeps handling messages.
+    """
+
+    def __init__(self, config, path: str, delay: float = 1):
+        self.config = config
+        self.path = path
+        self.delay = delay
+        self.task = None
+        # Created on first use in the running event loop, as setup() runs before the loop is started
+        self.lock = None
+
+    def schedule(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.save_later())
+
+    async def save_later(self):
+        await asyncio.sleep(self.delay)
+        self.task = None
+        try:
+            await self.save()
+        except OSError as e:
+            logging.error("Could not save %s: %s", self.path, e)
+
+    async def save(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if await asyncio.to_thread(save_atomically, self.config, self.path):
+                logging.info("Saved %s", self.path)
+
+    async def flush(self):
+        """Writes scheduled changes immediately, e.g. on shutdown"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        # Waits for a save that is in progress and does not write if the file is up to date
+        await self.save()
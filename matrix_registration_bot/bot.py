@@ -1,258 +1,761 @@
-import cryptography
-import simplematrixbotlib as botlib
+import asyncio
+import contextlib
 import matrix_registration_bot
+from matrix_registration_bot import logs, metrics
 from matrix_registration_bot.registration_api import RegistrationAPI
-from matrix_registration_bot.config import Config
+from matrix_registration_bot.allowlist import AllowlistMatcher, ConfigSaver
+from matrix_registration_bot.config import Config, to_bool
+from matrix_registration_bot.messages import send_reply
+from matrix_registration_bot.notifications import TokenNotifier
+from matrix_registration_bot.rate_limit import RateLimiter
+from matrix_registration_bot.snapshots import SnapshotStore
+from matrix_registration_bot.token_store import TokenStore
+from matrix_registration_bot.transfer import FORMATS, export_lines, guess_format, read_tokens, write_export
 import logging
 import argparse
+import os
+import re
+import signal
+import sys
+import time
+from typing import Callable, NamedTuple
+from urllib.parse import urlparse
+import yaml
 
-parser = argparse.ArgumentParser(description='Start the matrix-registration-bot.')
-
-parser.add_argument('--config', default=None, help='Specify a configuration file to use')
-
-args = parser.parse_args()
-if args.config is None:
-    config_path = 'config.yml'
-else:
-    config_path = args.config
-config = Config(args.config)
-
-bot_server = config['bot']['server']
-bot_username = config['bot']['username']
-try:
-    bot_access_token = config['bot']['access_token']
-    creds = botlib.Creds(bot_server,
-                         username=bot_username,
-                         access_token=bot_access_token)
-except KeyError:
-    logging.info("Using password based authentication for the bot")
+"""
+The bot is set up by setup() and not on import, so importing this module is cheap and free of side effects. The heavy
+Matrix dependencies (simplematrixbotlib, matrix-nio with e2e, cryptography) are only imported when the bot is started.
+"""
+config = None
+bot = None
+# Admin API connections by homeserver name and the connection to the default (first) homeserver
+apis = {}
+api = None
+bot_prefix = ""
+help_string = ""
+# Set in setup() from the allow- and blocklist of the simple-matrix-bot config
+allowlist_matcher = None
+config_saver = None
+# Limit how often a single user and all users of a room can use restricted commands
+user_rate_limiter = None
+room_rate_limiter = None
+# The SnapshotStore of each homeserver by name, set in main() if token statistics are enabled
+snapshot_stores = None
+stats_path = None
+# Running TokenNotifier tasks, restarted when the configuration is reloaded
+notifier_tasks = []
+# Homeserver connections replaced by a reload that are not closed yet and the tasks closing them
+replaced_apis = set()
+closing_tasks = set()
+# Counts the configuration reloads. running_jobs counts the commands and background jobs in progress by the generation
+# they started in.
+config_generation = 0
+running_jobs = {}
+SIMPLE_MATRIX_BOT_CONFIG_FILE = "config.toml"
+# TokenStores by path, shared by all homeservers storing their API token in the same file
+token_stores = {}
+
+
+def same_server(url, other_url):
+    """Checks if two URLs point to the same server, ignoring the case of the host and trailing slashes"""
+    parsed, other_parsed = urlparse(url), urlparse(other_url)
+    return (parsed.scheme.lower(), parsed.netloc.lower(), parsed.path.rstrip("/")) == \
+        (other_parsed.scheme.lower(), other_parsed.netloc.lower(), other_parsed.path.rstrip("/"))
+
+
+def create_api(api_config, bot_config):
+    """
+    Creates the connection to the admin API of one homeserver
+
+    :param api_config: The api section of the config or an entry of the homeservers list
+    :param bot_config: The bot section of the config, used as fallback for the server and credentials
+    :return: A RegistrationAPI
+    """
     try:
-        bot_access_password = config['bot']['password']
+        api_base_url = api_config['base_url']
     except KeyError:
-        error = "No access token or password for the bot provided"
-        logging.error(error)
-        raise KeyError(error)
-    creds = botlib.Creds(bot_server,
-                         username=bot_username,
-                         password=bot_access_password)
+        api_base_url = bot_config['server']
 
-bot_prefix = config['bot']['prefix']
+    # Optional tuning options of the admin API connection and the type they are converted to
+    api_options = {}
+    for option, option_type in [("max_concurrency", int), ("cache_ttl", float), ("connection_limit", int),
+                                ("keepalive_timeout", float), ("dns_cache_ttl", int), ("connect_timeout", float),
+                                ("read_timeout", float), ("max_retries", int), ("circuit_failure_threshold", int),
+                                ("circuit_reset_timeout", float)]:
+        try:
+            api_options[option] = option_type(api_config[option])
+        except KeyError:
+            pass
 
-# Load a config file that configures bot behaviour
-smbl_config = botlib.Config()
-smbl_config.emoji_verify = True
-smbl_config.ignore_unverified_devices = True
-SIMPLE_MATRIX_BOT_CONFIG_FILE = "config.toml"
-try:
-    smbl_config.load_toml(SIMPLE_MATRIX_BOT_CONFIG_FILE)
-    logging.info(f"Loaded the simple-matrix-bot config file {SIMPLE_MATRIX_BOT_CONFIG_FILE}")
-except FileNotFoundError:
-    logging.info(f"No simple-matrix-bot config file found. Creating {SIMPLE_MATRIX_BOT_CONFIG_FILE}")
-    smbl_config.save_toml(SIMPLE_MATRIX_BOT_CONFIG_FILE)
+    """
+    Here we get the configured credentials for the admin API.
+    We first check if an API token is set, if not we try if there are credentials set in the api section of the config
+    and after that we use the credentials provided for the bot. Users are encouraged to use the last option, but we
+    allow to overwrite this.
+    """
+    try:
+        api_token = api_config['token']
+        logging.info("Using API token from config for %s", api_base_url)
+        return RegistrationAPI(api_base_url, api_token, **api_options)
+    except KeyError:
+        try:
+            admin_username = api_config['username']
+            admin_password = api_config['password']
+            logging.info("Using username/password from config for %s", api_base_url)
+        except KeyError:
+            # The bot account only exists on its own homeserver
+            if not same_server(api_base_url, bot_config['server']):
+                raise KeyError(f"No token or username/password configured for {api_base_url}")
+            admin_username = bot_config['username']
+            admin_password = bot_config['password']
+            logging.info("Using username/password from bot section of config for %s", api_base_url)
+        # The API interface will obtain an API token by itself and keep it for the next start
+        try:
+            token_store_path = api_config['token_store']
+        except KeyError:
+            token_store_path = "api_token.json"
+        if token_store_path:
+            api_options["token_store"] = token_stores.setdefault(token_store_path, TokenStore(token_store_path))
+        return RegistrationAPI(api_base_url, username=admin_username, password=admin_password, **api_options)
 
-bot = botlib.Bot(creds, smbl_config)
 
-try:
-    api_base_url = config['api']['base_url']
-except KeyError:
-    api_base_url = bot_server
+def homeserver_configs(config):
+    """
+    Homeservers are configured as a list in the homeservers section. Without it, the api section configures the only
+    homeserver.
 
-"""
-Here we get the configured credentials for the admin API.
-We first check if an API token is set, if not we try if there are credentials set in the api section of the config
-and after that we use the credentials provided for the bot. Users are encouraged to use the last option, but we allow
-to overwrite this.
-"""
-try:
-    api_token = config['api']['token']
-    api = RegistrationAPI(api_base_url, api_token)
-    logging.info("Using API token from api section of config")
-except KeyError:
+    :param config: The bot configuration
+    :return: Dictionary of the config of each homeserver by name. The first one is the default.
+    """
     try:
-        admin_username = config['api']['username']
-        admin_password = config['api']['password']
-        logging.info("Using username/password from api section of config")
+        servers = config['homeservers']
     except KeyError:
-        admin_username = config['bot']['username']
-        admin_password = config['bot']['password']
-        logging.info("Using username/password from bot section of config")
-    # The API interface will obtain an API token by itself
-    api = RegistrationAPI(api_base_url, username=admin_username, password=admin_password)
-
-help_string = (
-    f"""**[Matrix Registration Bot](https://github.com/moan0s/matrix-registration-bot/)** {matrix_registration_bot.__version__}
+        servers = [config.get('api', {})]
+    configs = {}
+    for server in servers:
+        try:
+            name = server['name']
+        except KeyError:
+            name = urlparse(server.get('base_url', config['bot']['server'])).hostname
+        if name in configs:
+            raise ValueError(f"The homeserver name {name} is used more than once")
+        configs[name] = server
+    return configs
+
+
+def bot_login(config):
+    """:return: The options of the bot section the admin API connections might depend on"""
+    return {key: config['bot'].get(key) for key in ["server", "username", "password"]}
+
+
+def create_apis(config, previous=None):
+    """
+    Creates one admin API connection per configured homeserver
+
+    :param config: The bot configuration
+    :param previous: Optional tuple of (bot configuration, dictionary of RegistrationAPIs) in use before. Connections
+        whose configuration did not change are reused, keeping their connection pool and token index.
+    :return: Dictionary of RegistrationAPIs by homeserver name. The first one is the default.
+    """
+    reusable = {}
+    if previous is not None:
+        previous_config, previous_apis = previous
+        if bot_login(previous_config) == bot_login(config):
+            reusable = homeserver_configs(previous_config)
+    server_apis = {}
+    for name, server in homeserver_configs(config).items():
+        if name in reusable and reusable[name] == server:
+            server_apis[name] = previous_apis[name]
+        else:
+            server_apis[name] = create_api(server, config['bot'])
+    return server_apis
+
+
+def select_apis(args, allow_all=False):
+    """
+    Splits the homeserver selection off the arguments of a command
+
+    A homeserver is selected with @name, all homeservers with "all" (if allow_all is set). Without a selection the
+    default homeserver is used.
+
+    :param args: The arguments of the command
+    :return: Tuple of (list of (name, RegistrationAPI), remaining arguments)
+    """
+    selected = []
+    remaining = []
+    for arg in args:
+        if allow_all and arg == "all":
+            selected = list(apis.items())
+        elif arg.startswith("@") and arg[1:] in apis:
+            selected.append((arg[1:], apis[arg[1:]]))
+        else:
+            remaining.append(arg)
+    if len(selected) == 0:
+        selected = [next(iter(apis.items()))]
+    # Keep the order but select each homeserver only once
+    return list(dict(selected).items()), remaining
+
+
+def server_title(name, targets):
+    """
+    :return: A markdown header naming the homeserver if a command targets more than one homeserver, else ""
+    """
+    return f"**{name}**\n" if len(targets) > 1 else ""
+
+
+def setup(bot_config):
+    """
+    Creates the Matrix bot and the admin API connection and registers the message handler
+
+    :param bot_config: The bot configuration
+    """
+    global config, bot, apis, api, bot_prefix, help_string, user_rate_limiter, room_rate_limiter, \
+        allowlist_matcher, config_saver
+    import simplematrixbotlib as botlib
+
+    config = bot_config
+    bot_server = config['bot']['server']
+    bot_username = config['bot']['username']
+    try:
+        bot_access_token = config['bot']['access_token']
+        creds = botlib.Creds(bot_server,
+                             username=bot_username,
+                             access_token=bot_access_token)
+    except KeyError:
+        logging.info("Using password based authentication for the bot")
+        try:
+            bot_access_password = config['bot']['password']
+        except KeyError:
+            error = "No access token or password for the bot provided"
+            logging.error(error)
+            raise KeyError(error)
+        creds = botlib.Creds(bot_server,
+                             username=bot_username,
+                             password=bot_access_password)
+
+    bot_prefix = config['bot']['prefix']
+
+    # Load a config file that configures bot behaviour
+    smbl_config = botlib.Config()
+    smbl_config.emoji_verify = True
+    smbl_config.ignore_unverified_devices = True
+    try:
+        smbl_config.load_toml(SIMPLE_MATRIX_BOT_CONFIG_FILE)
+        logging.info("Loaded the simple-matrix-bot config file %s", SIMPLE_MATRIX_BOT_CONFIG_FILE)
+    except FileNotFoundError:
+        logging.info("No simple-matrix-bot config file found. Creating %s", SIMPLE_MATRIX_BOT_CONFIG_FILE)
+        smbl_config.save_toml(SIMPLE_MATRIX_BOT_CONFIG_FILE)
+
+    bot = botlib.Bot(creds, smbl_config)
+    allowlist_matcher = AllowlistMatcher(smbl_config)
+    config_saver = ConfigSaver(smbl_config, SIMPLE_MATRIX_BOT_CONFIG_FILE)
+    apis = create_apis(config)
+    api = next(iter(apis.values()))
+    help_string = generate_help_string()
+    user_rate_limiter, room_rate_limiter = create_rate_limiters(config)
+    bot.listener.on_message_event(token_actions)
+
+
+def create_rate_limiters(bot_config):
+    """
+    :return: Tuple of the RateLimiters for users and rooms, (None, None) if rate limiting is disabled
+    """
+    try:
+        rate_limit_enabled = to_bool(bot_config['rate_limit']['enabled'])
+    except KeyError:
+        rate_limit_enabled = True
+    if not rate_limit_enabled:
+        return None, None
+    rate_limit_options = {"user_rate": 0.2, "user_burst": 10, "room_rate": 1, "room_burst": 20}
+    for option in rate_limit_options:
+        try:
+            rate_limit_options[option] = float(bot_config['rate_limit'][option])
+        except KeyError:
+            pass
+    return (RateLimiter(rate_limit_options["user_rate"], rate_limit_options["user_burst"]),
+            RateLimiter(rate_limit_options["room_rate"], rate_limit_options["room_burst"]))
+
+
+def rate_limited(sender, room_id):
+    """
+    Takes a token from the rate limit buckets of the sender and the room
+
+    :return: 0 if the command may be executed, else the seconds until the next command would be allowed
+    """
+    retry_in = 0
+    for limiter, key in [(user_rate_limiter, sender), (room_rate_limiter, room_id)]:
+        if limiter is not None:
+            allowed, wait = limiter.allow(key)
+            retry_in = max(retry_in, wait)
+    return max(retry_in, 1) if retry_in else 0
+
+
+def allowed_required(func, command_name=None):
+    if command_name is None:
+        command_name = func.__name__.removeprefix("action_")
+
+    async def wrapper(match, room, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            if allowlist_matcher.is_allowed(match.event.sender):
+                retry_in = rate_limited(match.event.sender, room.room_id)
+                if retry_in:
+                    logging.info("%s was rate limited when trying to execute %s", match.event.sender, func)
+                    await bot.api.send_markdown_message(
+                        room.room_id, f'You are sending commands too fast. Try again in {retry_in:.0f}s')
+                    metrics.commands_total.inc(command_name, "rate-limited")
+                    return
+                try:
+                    await func(match, room, *args, **kwargs)
+                except Exception:
+                    metrics.commands_total.inc(command_name, "error")
+                    raise
+                metrics.commands_total.inc(command_name, "ok")
+            else:
+                logging.info("%s tried to execute %s", match.event.sender, func)
+                await bot.api.send_markdown_message(
+                    room.room_id,
+                    f'You are not allowed to do that (restricted command). Ask someone to allow you (send `help` to '
+                    f'find out more)')
+                metrics.commands_total.inc(command_name, "denied")
+        finally:
+            # Failing and slow commands are the ones worth alerting on, so they are always measured
+            metrics.command_duration.observe(command_name, value=time.monotonic() - start)
+
+    return wrapper
+
+
+class Command(NamedTuple):
+    name: str
+    handler: Callable
+    args: str
+    help: str
+    restricted: bool
+
+
+# All commands the bot understands, by name
+commands = {}
+
+
+def command(name, args="", help="", restricted=True):
+    """
+    Registers the decorated function as handler of a bot command
+
+    :param name: The command as typed after the prefix
+    :param args: The arguments of the command as shown in the help
+    :param help: A short description of the command
+    :param restricted: Whether only allowed users may use the command
+    """
+    def decorator(func):
+        handler = allowed_required(func, name) if restricted else func
+        commands[name] = Command(name, handler, args, help, restricted)
+        return func
+
+    return decorator
+
+
+def generate_help_string():
+    def command_help(cmd):
+        usage = f"{bot_prefix}{cmd.name} {cmd.args}".strip()
+        return f"* `{usage}`: {cmd.help}"
+
+    unrestricted = "\n".join(command_help(cmd) for cmd in commands.values() if not cmd.restricted)
+    restricted = "\n".join(command_help(cmd) for cmd in commands.values() if cmd.restricted)
+    return f"""**[Matrix Registration Bot](https://github.com/moan0s/matrix-registration-bot/)** {matrix_registration_bot.__version__}
 You can always ask for help in
 [#matrix-registration-bot:hyteck.de](https://matrix.to/#/#matrix-registration-bot:hyteck.de)!
 
 **Unrestricted commands**
 
-* `{bot_prefix}help`: Shows this help
+{unrestricted}
 
 **Restricted commands**
 
-* `{bot_prefix}list`: Lists all registration tokens
-* `{bot_prefix}show <token>`: Shows token details in human-readable format
-* `{bot_prefix}create`: Creates a token that that is valid for one registration for seven days
-* `{bot_prefix}delete <token>` Deletes the specified token(s)
-* `{bot_prefix}delete-all` Deletes all tokens
-* `{bot_prefix}allow @user:example.com` Allows the specified user (or a user matching a regex pattern) to use restricted commands
-* `{bot_prefix}disallow @user:example.com` Stops a specified user (or a user matching a regex pattern) from using restricted commands
-""")
+{restricted}
+"""
 
 
-def allowed_required(func):
-    async def wrapper(match, room, *args, **kwargs):
-        if match.is_from_allowed_user():
-            await func(match, room, *args, **kwargs)
+@command("help", help="Shows this help", restricted=False)
+async def action_help(match, room):
+    """The help command should be accessible even to users that are not allowed"""
+    logging.info("%s viewed the help", match.event.sender)
+    await bot.api.send_markdown_message(room.room_id, help_string)
+
+
+LIST_PAGE_SIZE = 100
+LIST_FILTERS = {"--valid", "--expired", "--used-up", "--unlimited"}
+LIST_SORT_KEYS = {
+    "token": lambda token: token['token'],
+    # Tokens that do not expire or have unlimited uses are sorted last
+    "expiry": lambda token: (token['expiry_time'] is None, token['expiry_time'] or 0),
+    "uses": lambda token: (RegistrationAPI.uses_left(token) is None, RegistrationAPI.uses_left(token) or 0),
+}
+
+
+def parse_list_args(args):
+    """
+    Parses the arguments of the list command: list [--valid|--expired|--used-up|--unlimited] [--sort=<key>] [page <n>]
+
+    :return: Tuple of (set of filters, sort key or None, page number)
+    """
+    filters = set()
+    sort_key = None
+    page = 1
+    args = iter(args)
+    for arg in args:
+        if arg in LIST_FILTERS:
+            filters.add(arg[2:])
+        elif arg.startswith("--sort="):
+            sort_key = arg.split("=", maxsplit=1)[1]
+            if sort_key not in LIST_SORT_KEYS:
+                raise ValueError(f"Can not sort by {sort_key}, use one of {', '.join(LIST_SORT_KEYS)}")
+        elif arg == "page":
+            page = int(next(args, ""))
+            if page < 1:
+                raise ValueError("The page must be a positive number")
         else:
-            logging.info(f"{match.event.sender} tried to execute {func}")
-            await bot.api.send_markdown_message(
-                room.room_id,
-                f'You are not allowed to do that (restricted command). Ask someone to allow you (send `help` to find '
-                f'out more)')
+            raise ValueError(f"Unknown argument {arg}")
+    return filters, sort_key, page
 
-    return wrapper
+
+def filter_tokens(token_list, filters):
+    """
+    Yields the tokens matching at least one of the given filters (or all tokens if no filter is given)
+    """
+    now = int(time.time() * 1000)
+    for token in token_list:
+        if (not filters or RegistrationAPI.token_state(token, now) in filters
+                or ("unlimited" in filters and token['uses_allowed'] is None)):
+            yield token
 
 
-@allowed_required
+@command("list", args="[--valid|--expired|--used-up|--unlimited] [--sort=token|expiry|uses] [page <n>] [@server|all]",
+         help="Lists registration tokens, optionally filtered and sorted")
 async def action_list(match, room):
-    logging.info(f"{match.event.sender} listed all tokens")
+    logging.info("%s listed tokens %s", match.event.sender, match.args())
+    targets, args = select_apis(match.args(), allow_all=True)
     try:
-        token_list = await api.list_tokens()
-    except ConnectionError as e:
-        logging.warning(f"Error while trying to list all tokens: {e}")
-        await error_handler(room, e)
+        filters, sort_key, page = parse_list_args(args)
+    except ValueError as e:
+        await bot.api.send_markdown_message(
+            room.room_id,
+            f"Could not understand the command ({e}). Usage: `list [--valid|--expired|--used-up|--unlimited] "
+            f"[--sort=token|expiry|uses] [page <n>] [@server|all]`")
         return
-    if len(token_list) < 10:
-        message = "\n".join([RegistrationAPI.token_to_markdown(token) for token in token_list])
+    results = await asyncio.gather(*[target_api.list_tokens() for name, target_api in targets],
+                                   return_exceptions=True)
+    for (name, target_api), token_list in zip(targets, results):
+        if isinstance(token_list, (ConnectionError, PermissionError, FileNotFoundError)):
+            logging.warning("Error while trying to list all tokens of %s: %s", name, token_list)
+            await error_handler(room, token_list)
+        elif isinstance(token_list, Exception):
+            raise token_list
+        else:
+            await send_token_list(room, token_list, filters, sort_key, page, server_title(name, targets))
+
+
+async def send_token_list(room, token_list, filters, sort_key, page, title=""):
+    tokens = filter_tokens(token_list, filters)
+    if sort_key is not None:
+        tokens = sorted(tokens, key=LIST_SORT_KEYS[sort_key])
     else:
-        tokens_as_string = [RegistrationAPI.token_to_short_markdown(token) for token in token_list]
-        message = f"All tokens: {', '.join(tokens_as_string)}"
-    await bot.api.send_markdown_message(room.room_id, message)
+        tokens = list(tokens)
+    pages = max(1, -(-len(tokens) // LIST_PAGE_SIZE))
+    page_tokens = tokens[(page - 1) * LIST_PAGE_SIZE:page * LIST_PAGE_SIZE]
+    if len(page_tokens) == 0:
+        await bot.api.send_markdown_message(room.room_id, f"{title}No tokens found")
+        return
+    if len(page_tokens) < 10:
+        await send_reply(bot, room.room_id, (RegistrationAPI.token_to_markdown(token) for token in page_tokens),
+                         title=title)
+    else:
+        await send_reply(bot, room.room_id, (RegistrationAPI.token_to_short_markdown(token) for token in page_tokens),
+                         separator=", ", title=title)
+    if pages > 1:
+        await bot.api.send_markdown_message(
+            room.room_id, f"Page {page} of {pages} ({len(tokens)} tokens), use `{bot_prefix}list page <n>` to see more")
 
 
-@allowed_required
+@command("create", args="[<count> [uses=<n>] [days=<n>] [length=<n>] [prefix=<string>]] [@server|all]",
+         help="Creates a token that is valid for one registration for seven days, or multiple tokens at once")
 async def action_create_token(match, room):
+    targets, args = select_apis(match.args(), allow_all=True)
+    if len(args) > 0:
+        await create_tokens(match, room, args, targets)
+        return
+    results = await asyncio.gather(*[target_api.create_token() for name, target_api in targets],
+                                   return_exceptions=True)
+    for (name, target_api), token in zip(targets, results):
+        if isinstance(token, (ConnectionError, PermissionError, FileNotFoundError)):
+            logging.warning("Error while trying to create a token on %s: %s", name, token)
+            await error_handler(room, token)
+        elif isinstance(token, Exception):
+            raise token
+        else:
+            logging.info("%s created token %s on %s", match.event.sender, token, name)
+            await bot.api.send_markdown_message(room.room_id,
+                                                f"{server_title(name, targets)}"
+                                                f"{RegistrationAPI.token_to_markdown(token)}")
+
+
+MAX_BATCH_SIZE = 1000
+
+
+async def create_tokens(match, room, args, targets):
+    """
+    Creates a batch of tokens on each target: create <count> [uses=<n>] [days=<n>] [length=<n>] [prefix=<string>]
+
+    uses and days accept "unlimited" for tokens without a usage or time limit. The homeservers are called concurrently.
+    """
     try:
-        token = await api.create_token()
-        logging.info(f"{match.event.sender} created token {token}")
-        await bot.api.send_markdown_message(room.room_id, f"{RegistrationAPI.token_to_markdown(token)}")
-    except (ConnectionError, PermissionError, FileNotFoundError) as e:
-        logging.warning(f"Error while trying to create a token: {e}")
-        await error_handler(room, e)
+        count = int(args[0])
+        options = dict(arg.split("=", maxsplit=1) for arg in args[1:])
+        unknown = set(options) - {"uses", "days", "length", "prefix"}
+        if unknown:
+            raise ValueError(f"Unknown option(s) {', '.join(unknown)}")
+        uses_allowed = None if options.get("uses") == "unlimited" else int(options.get("uses", 1))
+        expiry_days = None if options.get("days") == "unlimited" else int(options.get("days", 7))
+        length = int(options["length"]) if "length" in options else None
+        prefix = options.get("prefix")
+    except ValueError as e:
+        await bot.api.send_markdown_message(
+            room.room_id,
+            f"Could not understand the command ({e}). Usage: `create <count> [uses=<n>] [days=<n>] [length=<n>] "
+            f"[prefix=<string>] [@server|all]`")
+        return
+    if not 0 < count <= MAX_BATCH_SIZE:
+        await bot.api.send_markdown_message(room.room_id,
+                                            f"The number of tokens must be between 1 and {MAX_BATCH_SIZE}")
+        return
+    results = await asyncio.gather(*[target_api.create_tokens(count, expiry_days=expiry_days, uses_allowed=uses_allowed,
+                                                              length=length, prefix=prefix)
+                                     for name, target_api in targets], return_exceptions=True)
+    for (name, target_api), result in zip(targets, results):
+        if isinstance(result, (ConnectionError, PermissionError, FileNotFoundError, ValueError)):
+            logging.warning("Error while trying to create tokens on %s: %s", name, result)
+            await error_handler(room, result)
+            continue
+        elif isinstance(result, Exception):
+            raise result
+        created_tokens, errors = result
+        logging.info("%s created %s tokens on %s (%s failed)", match.event.sender, len(created_tokens), name,
+                     len(errors))
+        await send_info_on_created_tokens(room, created_tokens, errors, server_title(name, targets))
 
 
-@allowed_required
+@command("delete", args="<token> [@server]", help="Deletes the specified token(s)")
 async def action_delete(match, room):
-    deleted_tokens = []
-    logging.info(f"{match.event.sender} tries to delete {match.args()}")
-    if not len(match.args()) > 0:
+    logging.info("%s tries to delete %s", match.event.sender, match.args())
+    targets, args = select_apis(match.args())
+    name, target_api = targets[0]
+    if not len(args) > 0:
         await bot.api.send_markdown_message(room.room_id, "You must give a token!")
-    for token in match.args():
-        token = token.strip()
-        try:
-            deleted_tokens.append(await api.delete_token(token))
-        except ValueError as e:
-            logging.info(f"Token {token} given by {match.event.sender} to delete was not in correct format")
-            await error_handler(room, e)
-        except FileNotFoundError as e:
-            logging.info(f"Token {token} given by {match.event.sender} to delete was not found")
-            await error_handler(room, e)
-        except ConnectionError as e:
-            logging.warning(f"Error: {e} while trying to get a token")
-            await error_handler(room, e)
-    logging.info(f"{match.event.sender} deleted token {deleted_tokens}")
-    await send_info_on_deleted_token(room, deleted_tokens)
+        return
+    tokens = [token.strip() for token in args]
+    deleted_tokens, failed_tokens = await target_api.delete_tokens(tokens)
+    for token, error in failed_tokens:
+        if isinstance(error, ValueError):
+            logging.info("Token %s given by %s to delete was not in correct format", token, match.event.sender)
+        elif isinstance(error, FileNotFoundError):
+            logging.info("Token %s given by %s to delete was not found", token, match.event.sender)
+        else:
+            logging.warning("Error: %s while trying to delete token %s", error, token)
+    logging.info("%s deleted token %s on %s", match.event.sender, deleted_tokens, name)
+    await send_info_on_deleted_token(room, deleted_tokens, failed_tokens)
 
 
-@allowed_required
+@command("delete-all", args="[@server|all]", help="Deletes all tokens")
 async def action_delete_all(match, room):
-    deleted_tokens = await api.delete_all_token()
-    logging.info(f"{match.event.sender} deleted all tokens")
-    await send_info_on_deleted_token(room, deleted_tokens)
+    targets, args = select_apis(match.args(), allow_all=True)
+    results = await asyncio.gather(*[target_api.delete_all_token() for name, target_api in targets],
+                                   return_exceptions=True)
+    for (name, target_api), result in zip(targets, results):
+        if isinstance(result, (ConnectionError, PermissionError, FileNotFoundError)):
+            logging.warning("Error while trying to list all tokens of %s for deletion: %s", name, result)
+            await error_handler(room, result)
+            continue
+        elif isinstance(result, Exception):
+            raise result
+        deleted_tokens, failed_tokens = result
+        logging.info("%s deleted all tokens on %s (%s deleted, %s failed)", match.event.sender, name,
+                     len(deleted_tokens), len(failed_tokens))
+        await send_info_on_deleted_token(room, deleted_tokens, failed_tokens, server_title(name, targets))
 
 
-@allowed_required
+@command("show", args="<token> [@server]", help="Shows token details in human-readable format")
 async def action_show(match, room):
     tokens_info = []
-    logging.info(f"{match.event.sender} tries to show {match.args()}")
-    if not len(match.args()) > 0:
+    logging.info("%s tries to show %s", match.event.sender, match.args())
+    targets, args = select_apis(match.args())
+    name, target_api = targets[0]
+    if not len(args) > 0:
         await bot.api.send_markdown_message(room.room_id, "You must give a token!")
         return
-    for token in match.args():
+    for token in args:
         token = token.strip()
         try:
-            token_info = await api.get_token(token)
-            logging.info(f"Showing {token} to {match.event.sender}")
+            token_info = await target_api.get_token(token)
+            logging.info("Showing %s to %s", token, match.event.sender)
             tokens_info.append(RegistrationAPI.token_to_markdown(token_info))
-        except ConnectionError as e:
-            logging.warning(f"Error while trying to get a token: {e}")
+        except (ConnectionError, PermissionError) as e:
+            logging.warning("Error while trying to get a token: %s", e)
             await error_handler(room, e)
         except FileNotFoundError as e:
-            logging.info(f"Token {token} given by {match.event.sender} to show was not found")
+            logging.info("Token %s given by %s to show was not found", token, match.event.sender)
             await error_handler(room, e)
         except TypeError as e:
-            logging.info(f"Token {token} given by {match.event.sender} to show was not in correct format")
+            logging.info("Token %s given by %s to show was not in correct format", token, match.event.sender)
             await error_handler(room, e)
     if len(tokens_info) > 0:
-        await bot.api.send_markdown_message(room.room_id, "\n".join(tokens_info))
+        await send_reply(bot, room.room_id, tokens_info)
+
+
+@command("stats", args="[@server]",
+         help="Shows registrations per day, the most used tokens and tokens that are nearly used up")
+async def action_stats(match, room):
+    logging.info("%s viewed the stats", match.event.sender)
+    if snapshot_stores is None:
+        await bot.api.send_markdown_message(room.room_id, "Token statistics are not enabled (see `stats` in the "
+                                                          "configuration)")
+        return
+    targets, args = select_apis(match.args())
+    name, target_api = targets[0]
+    snapshot_store = get_snapshot_store(name)
+    per_day = await asyncio.to_thread(snapshot_store.registrations_per_day)
+    conversion_rates = await asyncio.to_thread(snapshot_store.conversion_rates)
+    nearly_exhausted = await asyncio.to_thread(snapshot_store.nearly_exhausted)
+    lines = [f"{server_title(name, apis)}**Registrations per day**"]
+    lines += [f"* {day}: {registrations}" for day, registrations in per_day] or ["* No registrations recorded yet"]
+    lines += ["", "**Most used tokens**"]
+    for token, completed, uses_allowed in conversion_rates:
+        if uses_allowed is None:
+            lines.append(f"* `{token}`: {completed} registrations (unlimited uses)")
+        else:
+            lines.append(f"* `{token}`: {completed} of {uses_allowed} uses ({completed / uses_allowed:.0%})")
+    lines += ["", "**Nearly used up or expiring within a day**"]
+    lines += [f"* `{token}`: {'unlimited' if uses_left is None else uses_left} uses left"
+              for token, uses_left, expiry_time in nearly_exhausted] or ["* None"]
+    await send_reply(bot, room.room_id, lines)
+
+
+@command("export", args="[csv|jsonl] [@server]", help="Exports all tokens as CSV (default) or JSON Lines")
+async def action_export(match, room):
+    logging.info("%s exported tokens %s", match.event.sender, match.args())
+    targets, args = select_apis(match.args())
+    export_format = args[0] if args else "csv"
+    if export_format not in FORMATS or len(args) > 1:
+        await bot.api.send_markdown_message(
+            room.room_id, f"Could not understand the command. Usage: `export [csv|jsonl] [@server]`")
+        return
+    name, target_api = targets[0]
+    try:
+        token_list = await target_api.list_tokens()
+    except (ConnectionError, PermissionError, FileNotFoundError) as e:
+        logging.warning("Error while trying to export the tokens of %s: %s", name, e)
+        await error_handler(room, e)
+        return
+    await send_reply(bot, room.room_id, export_lines(token_list, export_format), code_block=True,
+                     filename=f"tokens.{export_format}",
+                     mimetype="text/csv" if export_format == "csv" else "application/x-ndjson")
+
+
+@command("status", help="Shows whether the admin APIs are currently reachable")
+async def action_status(match, room):
+    logging.info("%s viewed the status", match.event.sender)
+    await bot.api.send_markdown_message(
+        room.room_id, "\n".join(f"* {name}: {target_api.circuit_breaker}" for name, target_api in apis.items()))
 
 
-@allowed_required
+@command("allow", args="@user:example.com",
+         help="Allows the specified user (or a user matching a regex pattern) to use restricted commands")
 async def action_allow(match, room):
     sender = match.event.sender
+    allowlist = bot.config.allowlist
     bot.config.add_allowlist(set(match.args()).union(set([sender,])))
-    bot.config.save_toml("config.toml")
-    logging.info(f"{match.event.sender} allowed {set(match.args())} (if valid)")
+    if bot.config.allowlist != allowlist:
+        config_saver.schedule()
+    logging.info("%s allowed %s (if valid)", match.event.sender, set(match.args()))
     await bot.api.send_text_message(
         room.room_id,
         f'allowing {", ".join(arg for arg in match.args())} (if valid)')
 
 
-@allowed_required
+@command("disallow", args="@user:example.com",
+         help="Stops a specified user (or a user matching a regex pattern) from using restricted commands")
 async def action_disallow(match, room):
+    allowlist = bot.config.allowlist
     bot.config.remove_allowlist(set(match.args()))
-    bot.config.save_toml("config.toml")
-    logging.info(f"{match.event.sender} disallowed {set(match.args())} (if valid)")
+    if bot.config.allowlist != allowlist:
+        config_saver.schedule()
+    logging.info("%s disallowed %s (if valid)", match.event.sender, set(match.args()))
     await bot.api.send_text_message(
         room.room_id,
         f'disallowing {", ".join(arg for arg in match.args())} (if valid)')
 
-@bot.listener.on_message_event
 async def token_actions(room, message):
-    match = botlib.MessageMatch(room, message, bot, bot_prefix)
-
-    if match.is_not_from_this_bot() and match.prefix():
-        # Unrestricted commands
-        if match.contains("help"):
-            """The help command should be accessible even to users that are not allowed"""
-            logging.info(f"{match.event.sender} viewed the help")
-            await bot.api.send_markdown_message(room.room_id, help_string)
-
-        # Restricted commands
-        if match.command("list"):
-            await action_list(match, room)
-        elif match.command("create"):
-            await action_create_token(match, room)
-        elif match.command("delete-all"):
-            await action_delete_all(match, room)
-        elif match.command("delete"):
-            await action_delete(match, room)
-        elif match.command("show"):
-            await action_show(match, room)
-        elif match.command("allow"):
-            await action_allow(match, room)
-        elif match.command("disallow"):
-            await action_disallow(match, room)
-
-
-async def send_info_on_deleted_token(room, token_list):
+    # Cheap pre-filter: most messages in a room are not meant for the bot and are dropped before any parsing
+    body = message.body
+    if not body.startswith(bot_prefix):
+        return
+    words = body[len(bot_prefix):].split(maxsplit=1)
+    cmd = commands.get(words[0]) if words else None
+    # Any message mentioning help shows the help, not only the help command itself
+    wants_help = "help" in body
+    if cmd is None and not wants_help:
+        return
+
+    from simplematrixbotlib import MessageMatch
+    match = MessageMatch(room, message, bot, bot_prefix)
+    if match.is_not_from_this_bot():
+        # Correlates the log records of this command, including those of its admin API requests
+        token = logs.request_id.set(logs.new_request_id())
+        try:
+            with running_job():
+                logging.debug("Handling a command from %s in %s", message.sender, room.room_id)
+                if wants_help:
+                    await commands["help"].handler(match, room)
+                if cmd is not None and cmd.name != "help":
+                    await cmd.handler(match, room)
+        finally:
+            logs.request_id.reset(token)
+
+
+@contextlib.contextmanager
+def running_job():
+    """Counts a command or background job as running in the current configuration generation until it is done"""
+    generation = config_generation
+    running_jobs[generation] = running_jobs.get(generation, 0) + 1
+    try:
+        yield
+    finally:
+        running_jobs[generation] -= 1
+        if running_jobs[generation] == 0:
+            del running_jobs[generation]
+
+
+async def send_info_on_deleted_token(room, token_list, failed_tokens=(), title=""):
     if len(token_list) > 0:
-        message = f"Deleted the following token(s): "
-        tokens_as_string = [RegistrationAPI.token_to_short_markdown(token) for token in token_list]
-        message += ", ".join(tokens_as_string)
+        await send_reply(bot, room.room_id, (RegistrationAPI.token_to_short_markdown(token) for token in token_list),
+                         separator=", ", title=f"{title}Deleted the following token(s): ",
+                         filename="deleted-tokens.txt")
     else:
-        message = "No token deleted"
+        await bot.api.send_markdown_message(room.room_id, f"{title}No token deleted")
+    if len(failed_tokens) > 0:
+        await send_reply(bot, room.room_id, (f"* `{token}`: {error}" for token, error in failed_tokens),
+                         title="Could not delete the following token(s):\n", filename="failed-tokens.txt")
+
+
+async def send_info_on_created_tokens(room, token_list, errors=(), title=""):
+    if len(token_list) > 0:
+        await send_reply(bot, room.room_id, (token["token"] for token in token_list), code_block=True,
+                         title=f"{title}Created {len(token_list)} token(s):\n", filename="created-tokens.txt")
+        # All tokens of a batch share their settings, so they are only shown once
+        details = RegistrationAPI.token_to_markdown(token_list[0]).split("\n")[1:]
+        message = "\n".join(line.strip() for line in details if line.strip())
+    else:
+        message = f"{title}No token created"
+    if len(errors) > 0:
+        message += f"\n\nCould not create {len(errors)} token(s): {errors[0]}"
     await bot.api.send_markdown_message(room.room_id, message)
 
 
@@ -262,9 +765,405 @@ async def error_handler(room, error):
     await bot.api.send_markdown_message(room.room_id, message)
 
 
-def run_bot():
+async def purge_tokens(name, target_api, dry_run: bool):
+    try:
+        purged_tokens, failed_tokens = await target_api.purge_tokens(dry_run=dry_run)
+        if dry_run:
+            logging.info("Purge (dry run) would delete %s token(s) on %s", len(purged_tokens), name)
+        else:
+            logging.info("Purged %s token(s) on %s", len(purged_tokens), name)
+        logging.debug("Purged tokens: %s", ', '.join(token['token'] for token in purged_tokens))
+        for token, error in failed_tokens:
+            logging.warning("Could not purge token %s on %s: %s", token, name, error)
+    except (ConnectionError, PermissionError, FileNotFoundError) as e:
+        logging.warning("Error while trying to purge tokens on %s: %s", name, e)
+
+
+async def purge_tokens_periodically(interval: float, dry_run: bool):
+    """Deletes expired and used up tokens on all homeservers every interval seconds"""
+    while True:
+        logs.request_id.set(f"purge-{logs.new_request_id()}")
+        with running_job():
+            await asyncio.gather(*[purge_tokens(name, target_api, dry_run) for name, target_api in apis.items()])
+        await asyncio.sleep(interval)
+
+
+def get_snapshot_store(name):
+    """
+    Opens the token statistics of a homeserver on first use
+
+    The default homeserver uses the configured path, every other homeserver a database next to it named after the
+    homeserver (e.g. token_stats-example.org.sqlite).
+    """
+    try:
+        return snapshot_stores[name]
+    except KeyError:
+        pass
+    path = stats_path
+    if name != next(iter(apis)):
+        stem, extension = os.path.splitext(stats_path)
+        path = f"{stem}-{re.sub(r'[^a-zA-Z0-9_.-]', '_', name)}{extension}"
+    snapshot_stores[name] = SnapshotStore(path)
+    return snapshot_stores[name]
+
+
+async def record_snapshot(name, target_api):
+    try:
+        token_list = await target_api.list_tokens(use_cache=False)
+        await asyncio.to_thread(get_snapshot_store(name).record, token_list)
+    except (ConnectionError, PermissionError, FileNotFoundError) as e:
+        logging.warning("Error while trying to record a token snapshot of %s: %s", name, e)
+
+
+async def record_snapshots_periodically(interval: float):
+    """Records a snapshot of all tokens of each homeserver for the token statistics every interval seconds"""
+    while True:
+        logs.request_id.set(f"stats-{logs.new_request_id()}")
+        with running_job():
+            await asyncio.gather(*[record_snapshot(name, target_api) for name, target_api in apis.items()])
+        await asyncio.sleep(interval)
+
+
+def notifications_enabled(bot_config):
+    try:
+        return to_bool(bot_config['notifications']['enabled'])
+    except KeyError:
+        return False
+
+
+def create_notifiers(bot_config):
+    """
+    :return: A TokenNotifier for every homeserver, posting to the configured admin room
+    """
+    try:
+        room_id = bot_config['notifications']['room']
+    except KeyError:
+        error = "No room for the notifications provided"
+        logging.error(error)
+        raise KeyError(error)
+    options = {"expiry_warning": 24 * 3600, "low_stock": 0, "refill": 0, "refill_expiry_days": 7,
+               "refill_uses_allowed": 1}
+    for option, default in options.items():
+        try:
+            options[option] = type(default)(bot_config['notifications'][option])
+        except KeyError:
+            pass
+    notifiers = []
+    for name, target_api in apis.items():
+        title = server_title(name, apis)
+
+        async def send(message, title=title):
+            await bot.api.send_markdown_message(room_id, f"{title}{message}")
+
+        notifiers.append(TokenNotifier(target_api, send, **options))
+    return notifiers
+
+
+async def close_when_idle(old_apis, generation: int, old_tasks=()):
+    """
+    Closes replaced admin API connections once all commands and background jobs started before the given generation
+    are done and the cancelled old_tasks (e.g. the notifiers of the old configuration) have ended
+    """
+    await asyncio.gather(*old_tasks, return_exceptions=True)
+    while any(started < generation for started in running_jobs):
+        await asyncio.sleep(1)
+    await asyncio.gather(*[old_api.close() for old_api in old_apis])
+    replaced_apis.difference_update(old_apis)
+
+
+def reload_config():
+    """
+    Reads the configuration again and applies the prefix, logging, rate limits, notifications and homeservers
+
+    Connections to homeservers whose configuration did not change are kept. The new configuration is swapped in without
+    giving control to the event loop, so a command uses either the old or the new configuration. Replaced connections
+    are closed when the commands and background jobs still using them are done. Changes of the Matrix login of the bot
+    only apply after a restart.
+
+    :return: True if the configuration was reloaded, False if it is invalid and the current one is kept
+    """
+    global config, apis, api, bot_prefix, help_string, user_rate_limiter, room_rate_limiter, config_generation
+    try:
+        new_config = Config(config.path)
+        new_apis = create_apis(new_config, previous=(config, apis))
+        new_rate_limiters = create_rate_limiters(new_config)
+        if notifications_enabled(new_config) and 'room' not in new_config['notifications']:
+            raise KeyError("No room for the notifications provided")
+    except (KeyError, ValueError, TypeError, OSError, yaml.YAMLError) as e:
+        logging.error("Could not reload the configuration, keeping the current one: %r", e)
+        config.apply_logging()
+        return False
+    if bot_login(new_config) != bot_login(config) or new_config['bot'].get('access_token') != config['bot'].get(
+            'access_token'):
+        logging.warning("The Matrix login of the bot changed, restart the bot to apply it")
+
+    old_apis = [old_api for old_api in apis.values() if old_api not in new_apis.values()]
+    config = new_config
+    apis = new_apis
+    api = next(iter(apis.values()))
+    bot_prefix = config['bot']['prefix']
+    help_string = generate_help_string()
+    user_rate_limiter, room_rate_limiter = new_rate_limiters
+    config_generation += 1
+
+    old_notifier_tasks = list(notifier_tasks)
+    for task in old_notifier_tasks:
+        task.cancel()
+    notifier_tasks.clear()
+    if notifications_enabled(config):
+        notifier_tasks.extend(asyncio.create_task(notifier.run()) for notifier in create_notifiers(config))
+    if old_apis:
+        replaced_apis.update(old_apis)
+        closing_task = asyncio.create_task(close_when_idle(old_apis, config_generation, old_notifier_tasks))
+        closing_tasks.add(closing_task)
+        closing_task.add_done_callback(closing_tasks.discard)
+    logging.info("Reloaded the configuration from %s, replaced %s homeserver connection(s)", config.path,
+                 len(old_apis))
+    return True
+
+
+async def watch_config_file(interval: float):
+    """Reloads the configuration whenever the modification time of the config file changes"""
+    def modification_time():
+        try:
+            return os.stat(config.path).st_mtime_ns
+        except OSError:
+            return None
+
+    last_modified = modification_time()
+    while True:
+        await asyncio.sleep(interval)
+        modified = modification_time()
+        if modified != last_modified:
+            last_modified = modified
+            try:
+                reload_config()
+            except Exception:
+                # An unexpected error must not end the watcher, later changes are still reloaded
+                logging.exception("Could not reload the configuration")
+
+
+async def main():
+    global snapshot_stores, stats_path
+    background_tasks = []
+
+    # Reload the configuration on SIGHUP (not available on Windows) and optionally when the config file changes
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_config)
+    except (AttributeError, NotImplementedError):
+        logging.info("Reloading the configuration on SIGHUP is not supported on this platform")
+    try:
+        watch_enabled = to_bool(config['reload']['watch'])
+    except KeyError:
+        watch_enabled = False
+    if watch_enabled:
+        try:
+            watch_interval = float(config['reload']['interval'])
+        except KeyError:
+            watch_interval = 5
+        background_tasks.append(asyncio.create_task(watch_config_file(watch_interval)))
+
+    # Automatic deletion of expired and used up tokens
+    try:
+        purge_enabled = to_bool(config['purge']['enabled'])
+    except KeyError:
+        purge_enabled = False
+    if purge_enabled:
+        try:
+            purge_interval = float(config['purge']['interval'])
+        except KeyError:
+            purge_interval = 3600
+        try:
+            purge_dry_run = to_bool(config['purge']['dry_run'])
+        except KeyError:
+            purge_dry_run = False
+        background_tasks.append(asyncio.create_task(purge_tokens_periodically(purge_interval, purge_dry_run)))
+
+    # Token statistics
+    try:
+        stats_enabled = to_bool(config['stats']['enabled'])
+    except KeyError:
+        stats_enabled = False
+    if stats_enabled:
+        try:
+            stats_path = config['stats']['path']
+        except KeyError:
+            stats_path = "token_stats.sqlite"
+        try:
+            stats_interval = float(config['stats']['interval'])
+        except KeyError:
+            stats_interval = 3600
+        snapshot_stores = {}
+        background_tasks.append(asyncio.create_task(record_snapshots_periodically(stats_interval)))
+
+    # Optional notifications about expiring and used up tokens
+    if notifications_enabled(config):
+        notifier_tasks[:] = [asyncio.create_task(notifier.run()) for notifier in create_notifiers(config)]
+
+    # Optional metrics endpoint
+    try:
+        metrics_enabled = to_bool(config['metrics']['enabled'])
+    except KeyError:
+        metrics_enabled = False
+    metrics_runner = None
+    if metrics_enabled:
+        try:
+            metrics_host = config['metrics']['host']
+        except KeyError:
+            metrics_host = "127.0.0.1"
+        try:
+            metrics_port = int(config['metrics']['port'])
+        except KeyError:
+            metrics_port = 9100
+        metrics_runner = await metrics.start_metrics_server(metrics_host, metrics_port)
+
+    try:
+        await bot.main()
+    finally:
+        background_tasks += notifier_tasks + list(closing_tasks)
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if snapshot_stores is not None:
+            for snapshot_store in snapshot_stores.values():
+                snapshot_store.close()
+        try:
+            await config_saver.flush()
+        except OSError as e:
+            logging.error("Could not save %s: %s", SIMPLE_MATRIX_BOT_CONFIG_FILE, e)
+        # Replaced connections whose commands were still running are closed here instead of by their closing task
+        await asyncio.gather(*[target_api.close() for target_api in list(apis.values()) + list(replaced_apis)])
+        replaced_apis.clear()
+
+
+async def check_health(health_apis):
+    """
+    Checks that the admin APIs are reachable and the credentials are accepted
+
+    :param health_apis: Dictionary of RegistrationAPIs by homeserver name
+    :return: True if the bot could list the registration tokens of all homeservers
+    """
+    async def check(name, health_api):
+        try:
+            token_list = await health_api.list_tokens(use_cache=False)
+            print(f"OK: {name} is reachable, {len(token_list)} registration tokens")
+            return True
+        except (ConnectionError, PermissionError, FileNotFoundError) as e:
+            print(f"ERROR: {name}: {e}")
+            return False
+        finally:
+            await health_api.close()
+
+    return all(await asyncio.gather(*[check(name, health_api) for name, health_api in health_apis.items()]))
+
+
+def select_cli_api(cli_apis, name=None):
+    """
+    :return: The RegistrationAPI of the homeserver with the given name, the default homeserver if name is None
+    """
+    if name is None:
+        return next(iter(cli_apis.values()))
+    try:
+        return cli_apis[name]
+    except KeyError:
+        raise KeyError(f"Unknown homeserver {name}, use one of {', '.join(cli_apis)}")
+
+
+async def export_tokens(cli_apis, args):
+    """Writes all tokens of a homeserver to a file or stdout"""
+    export_api = select_cli_api(cli_apis, args.homeserver)
+    export_format = args.format or guess_format(args.output)
+    try:
+        token_list = await export_api.list_tokens(use_cache=False)
+    finally:
+        await asyncio.gather(*[cli_api.close() for cli_api in cli_apis.values()])
+    if args.output == "-":
+        count = write_export(token_list, sys.stdout, export_format)
+    else:
+        with open(args.output, 'w', newline='') as file:
+            count = write_export(token_list, file, export_format)
+    print(f"Exported {count} token(s)", file=sys.stderr)
+
+
+async def import_tokens(cli_apis, args):
+    """
+    Creates the tokens of an exported file on a homeserver
+
+    :return: True if all tokens were imported
+    """
+    import_api = select_cli_api(cli_apis, args.homeserver)
+    import_format = args.format or guess_format(args.file)
+    with open(args.file, newline='') as file:
+        token_list = list(read_tokens(file, import_format))
+
+    def progress(finished, total):
+        print(f"\rImported {finished}/{total} token(s)", end="", file=sys.stderr)
+
+    try:
+        created_tokens, skipped, errors = await import_api.import_tokens(token_list, progress)
+    finally:
+        await asyncio.gather(*[cli_api.close() for cli_api in cli_apis.values()])
+    print(f"\nCreated {len(created_tokens)} token(s), skipped {len(skipped)} existing, expired or used up token(s)",
+          file=sys.stderr)
+    for token, error in errors:
+        print(f"ERROR: {token}: {error}", file=sys.stderr)
+    return len(errors) == 0
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Start the matrix-registration-bot.')
+    parser.add_argument('--config', default=None, help='Specify a configuration file to use')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.add_parser('run', help='Start the bot (default)')
+    subparsers.add_parser('health', help='Check that the admin API is reachable without connecting to Matrix')
+    subparsers.add_parser('version', help='Print the version and exit')
+    export_parser = subparsers.add_parser('export', help='Write all tokens to a CSV or JSON Lines file')
+    export_parser.add_argument('--output', default='-', help='File to write to (default: stdout)')
+    export_parser.add_argument('--format', choices=FORMATS, default=None,
+                               help='Output format (default: csv for .csv files, else jsonl)')
+    export_parser.add_argument('--homeserver', default=None, help='Name of the homeserver (default: the first one)')
+    import_parser = subparsers.add_parser('import', help='Create the tokens of an exported file, existing tokens are '
+                                                         'skipped so an interrupted import can be repeated')
+    import_parser.add_argument('file', help='A file written by the export command')
+    import_parser.add_argument('--format', choices=FORMATS, default=None,
+                               help='Input format (default: csv for .csv files, else jsonl)')
+    import_parser.add_argument('--homeserver', default=None, help='Name of the homeserver (default: the first one)')
+    return parser
+
+
+def run_bot(argv=None):
+    """
+    Entry point of the matrix-registration-bot command
+
+    :param argv: The command line arguments, defaults to sys.argv
+    """
+    args = create_parser().parse_args(argv)
+    if args.command == 'version':
+        print(matrix_registration_bot.__version__)
+        return
+
+    start = time.perf_counter()
+    bot_config = Config(args.config)
+    config_loaded = time.perf_counter()
+    if args.command == 'health':
+        healthy = asyncio.run(check_health(create_apis(bot_config)))
+        sys.exit(0 if healthy else 1)
+    if args.command == 'export':
+        asyncio.run(export_tokens(create_apis(bot_config), args))
+        return
+    if args.command == 'import':
+        imported = asyncio.run(import_tokens(create_apis(bot_config), args))
+        sys.exit(0 if imported else 1)
+
+    import cryptography.fernet
+    setup(bot_config)
+    set_up = time.perf_counter()
+    logging.info("Startup took %.0f ms (loading the config: %.0f ms, importing Matrix libraries and creating the bot: "
+                 "%.0f ms)", (set_up - start) * 1000, (config_loaded - start) * 1000, (set_up - config_loaded) * 1000)
     try:
-        bot.run()
+        asyncio.run(main())
     except cryptography.fernet.InvalidToken:
         logging.error("The token does not seem to fit the saved session. this can happen if you change the bot user."
                       "If this is the case, deleting the session.txt and restarting the bot might help")
@@ -0,0 +1,78 @@
+import logging
+import time
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a server that is failing
+
+    The breaker starts closed and lets every request through. After failure_threshold consecutive failures it opens
+    and rejects requests immediately for reset_timeout seconds. Afterwards it is half-open and lets a single trial
+    request through: if it succeeds the breaker closes again, if it fails the breaker opens for another reset_timeout.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def __str__(self):
+        if self.state == self.OPEN:
+            return (f"Circuit to {self.name} is open after {self.failures} failures, "
+                    f"next try in {self.retry_in():.0f}s")
+        return f"Circuit to {self.name} is {self.state} ({self.failures} consecutive failures)"
+
+    def retry_in(self):
+        """
+        :return: Seconds until the breaker lets a trial request through, 0 if it is not open
+        """
+        if self.state != self.OPEN:
+            return 0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def before_request(self):
+        """
+        Must be called before each request
+
+        :return: True if the request is the trial request of the half-open breaker
+        :raises ConnectionError: if the request must not be sent because the breaker is open
+        """
+        if self.state == self.OPEN and self.retry_in() == 0:
+            logging.info("Circuit to %s is half-open, sending a trial request", self.name)
+            self.state = self.HALF_OPEN
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.trial_in_progress):
+            raise ConnectionError(f"{self.name} seems to be unavailable, not sending the request. "
+                                  f"Retrying in {self.retry_in():.0f}s")
+        if self.state == self.HALF_OPEN:
+            self.trial_in_progress = True
+            return True
+        return False
+
+    def release_trial(self):
+        """Lets another request be the trial after the trial request ended without a result, e.g. as it was cancelled"""
+        if self.trial_in_progress:
+            logging.info("Trial request to %s ended without a result", self.name)
+        self.trial_in_progress = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info("Circuit to %s is closed again", self.name)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial_in_progress = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_progress = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning("Circuit to %s opened after %s consecutive failures", self.name, self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
@@ -1,18 +1,39 @@
 import logging
 import yaml
 from os import environ
+from matrix_registration_bot.logs import configure_logging
 
 
 class Config(dict):
     """A class to manage the bot's configuration"""
 
     keys = ["BOT_SERVER", "BOT_USERNAME", "BOT_PASSWORD", "BOT_ACCESS_TOKEN",
-            "API_BASE_URL", "API_TOKEN",
-            "LOGGING_LEVEL"]
+            "API_BASE_URL", "API_TOKEN", "API_MAX_CONCURRENCY", "API_CACHE_TTL", "API_CONNECTION_LIMIT",
+            "API_KEEPALIVE_TIMEOUT", "API_DNS_CACHE_TTL", "API_CONNECT_TIMEOUT", "API_READ_TIMEOUT",
+            "API_MAX_RETRIES", "API_CIRCUIT_FAILURE_THRESHOLD", "API_CIRCUIT_RESET_TIMEOUT", "API_TOKEN_STORE",
+            "PURGE_ENABLED", "PURGE_INTERVAL", "PURGE_DRY_RUN",
+            "METRICS_ENABLED", "METRICS_HOST", "METRICS_PORT",
+            "STATS_ENABLED", "STATS_PATH", "STATS_INTERVAL",
+            "RATE_LIMIT_ENABLED", "RATE_LIMIT_USER_RATE", "RATE_LIMIT_USER_BURST", "RATE_LIMIT_ROOM_RATE",
+            "RATE_LIMIT_ROOM_BURST",
+            "NOTIFICATIONS_ENABLED", "NOTIFICATIONS_ROOM", "NOTIFICATIONS_EXPIRY_WARNING", "NOTIFICATIONS_LOW_STOCK",
+            "NOTIFICATIONS_REFILL", "NOTIFICATIONS_REFILL_EXPIRY_DAYS", "NOTIFICATIONS_REFILL_USES_ALLOWED",
+            "RELOAD_WATCH", "RELOAD_INTERVAL",
+            "LOGGING_LEVEL", "LOGGING_FORMAT", "LOGGING_QUEUE"]
+    # Scopes whose name contains a "_" and therefore can not be split off at the first "_"
+    multi_word_scopes = ["rate_limit"]
 
-    def __init__(self, config_path=None):
-        logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.DEBUG)
+    @classmethod
+    def split_key(cls, key):
+        """Splits an environment variable name like "API_BASE_URL" into scope and key ("api", "base_url")"""
+        key = key.lower()
+        for scope in cls.multi_word_scopes:
+            if key.startswith(scope + "_"):
+                return scope, key[len(scope) + 1:]
+        scope, k = key.split("_", maxsplit=1)
+        return scope, k
 
+    def __init__(self, config_path=None):
         """
         The config is generated via 4 different paths from lowest to highest priority
         4. a config.yml in the working directory of the bot
@@ -24,17 +45,18 @@ class Config(dict):
         try:
             config_path = environ["CONFIG_PATH"]
         except KeyError:
-            logging.debug(f"No config file set via the environment variable")
+            logging.debug("No config file set via the environment variable")
             pass
         if config_path is None:
-            logging.debug(f"No config file set via the --config option, defaulting to config.yml in working directory")
+            logging.debug("No config file set via the --config option, defaulting to config.yml in working directory")
             config_path = "config.yml"
-        logging.info(f"Tying to load bot configuration from {config_path}")
+        logging.info("Tying to load bot configuration from %s", config_path)
+        self.path = config_path
         try:
             with open(config_path, 'r') as file:
-                self.extend_by_dict(yaml.safe_load(file))
+                self.extend_by_dict(yaml.safe_load(file) or {})
         except FileNotFoundError:
-            logging.error(f"Cold not find bot configuration at {config_path}")
+            logging.error("Cold not find bot configuration at %s", config_path)
 
 
         """
@@ -42,18 +64,18 @@ class Config(dict):
         e.g. self["logging"]["level"]. Does not support more than 2 level
         """
         for key in self.keys:
-            scope, k = [x.lower() for x in key.split("_", maxsplit=1)]
+            scope, k = self.split_key(key)
             try:
                 environ[key]
             except KeyError:
-                logging.debug(f"{key} not set in environment")
+                logging.debug("%s not set in environment", key)
                 continue
             try:
                 self[scope]
             except KeyError:
                 self[scope] = {}
             self[scope][k] = environ[key]
-            logging.debug(f"{key} set via environment")
+            logging.debug("%s set via environment", key)
 
         try:
             self["logging"]
@@ -61,20 +83,36 @@ class Config(dict):
             self["logging"] = dict()
             self["logging"]["level"] = "error"
 
-        """Set the logging level according to config"""
-        if self["logging"]['level'] in ["debug", "DEBUG"]:
-            logging_level = logging.DEBUG
-        elif self["logging"]['level'] in ["error", "ERROR"]:
-            logging_level = logging.ERROR
-        else:
-            logging_level = logging.INFO
-        logging.getLogger().setLevel(logging_level)
+        self.apply_logging()
 
         try:
             self["bot"]["prefix"]
         except KeyError:
             self["bot"]["prefix"] = ""
 
+    def apply_logging(self):
+        """Set up logging according to config"""
+        try:
+            logging_level = self["logging"]["level"]
+        except KeyError:
+            logging_level = "error"
+        try:
+            log_format = self["logging"]["format"]
+        except KeyError:
+            log_format = "text"
+        try:
+            log_queue = to_bool(self["logging"]["queue"])
+        except KeyError:
+            log_queue = False
+        configure_logging(logging_level, log_format, log_queue)
+
     def extend_by_dict(self, data):
         for key in data:
             self[key] = data[key]
+
+
+def to_bool(value):
+    """Interprets a config value that might be set via an environment variable (and therefore be a string) as bool"""
+    if isinstance(value, str):
+        return value.lower() in ["true", "yes", "on", "1"]
+    return bool(value)
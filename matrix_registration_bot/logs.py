@@ -0,0 +1,112 @@
+"""
+Logging setup of the bot
+
+Log records can be written as text or as JSON objects (one per line). Every record carries the ID of the bot command
+it belongs to, so the admin API calls of a command can be found in the log. Optionally, records are handed to a
+background thread through a queue, so writing the log never blocks the event loop.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import secrets
+import sys
+from contextvars import ContextVar
+
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR,
+          "critical": logging.CRITICAL}
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s]:%(message)s"
+
+# ID of the command (or background job) that is currently handled. Tasks started while handling it inherit the ID.
+request_id = ContextVar("request_id", default="-")
+
+# The handler and queue listener installed by configure_logging
+installed_handler = None
+queue_listener = None
+
+
+def new_request_id():
+    return secrets.token_hex(4)
+
+
+def parse_level(level):
+    """
+    :param level: A level name like "debug" or "WARNING" or a level number
+    :return: The logging level number, INFO for unknown names
+    """
+    if isinstance(level, int):
+        return level
+    return LEVELS.get(str(level).lower(), logging.INFO)
+
+
+class StderrHandler(logging.StreamHandler):
+    """Writes to the current sys.stderr, even if it was replaced after the handler was created"""
+
+    def __init__(self):
+        super().__init__(sys.stderr)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request ID to each record"""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line JSON object"""
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "request_id": getattr(record, "request_id", "-"), "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(level="error", log_format: str = "text", use_queue: bool = False):
+    """
+    Sets up the root logger, replacing a handler installed by an earlier call
+
+    :param level: The minimal level of logged records
+    :param log_format: "text" or "json"
+    :param use_queue: Write the log in a background thread
+    """
+    global installed_handler, queue_listener
+    root = logging.getLogger()
+    stop_queue_listener()
+    if installed_handler is not None:
+        root.removeHandler(installed_handler)
+    handler = StderrHandler()
+    handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+    if use_queue:
+        log_queue = queue.SimpleQueue()
+        queue_listener = logging.handlers.QueueListener(log_queue, handler)
+        queue_listener.start()
+        handler = logging.handlers.QueueHandler(log_queue)
+    # The filter runs in the thread that logs, where the context of the current command is known
+    handler.addFilter(RequestIdFilter())
+    root.addHandler(handler)
+    root.setLevel(parse_level(level))
+    installed_handler = handler
+
+
+def stop_queue_listener():
+    """Writes the records that are still queued and stops the background thread"""
+    global queue_listener
+    if queue_listener is not None:
+        queue_listener.stop()
+        queue_listener = None
+
+
+atexit.register(stop_queue_listener)
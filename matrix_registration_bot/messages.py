@@ -0,0 +1,112 @@
+"""Helpers to turn potentially long bot replies into messages that fit into a Matrix event"""
+import asyncio
+import io
+import itertools
+import logging
+
+# Matrix events are limited to 65536 bytes. The markdown body is sent twice (as body and as formatted HTML body),
+# so a message body is kept well below half of that.
+MAX_MESSAGE_SIZE = 16000
+# Replies that need more messages are uploaded as a file instead
+MAX_MESSAGES_PER_REPLY = 5
+# Limits how many messages and uploads the bot sends at the same time, across all replies
+MAX_CONCURRENT_SENDS = 4
+# The semaphore is created in the running event loop, before Python 3.10 it is bound to the loop it was created in
+send_slots = None
+send_slots_loop = None
+
+
+def get_send_slots():
+    global send_slots, send_slots_loop
+    loop = asyncio.get_running_loop()
+    if send_slots_loop is not loop:
+        send_slots = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+        send_slots_loop = loop
+    return send_slots
+
+
+def chunk_lines(lines, max_size: int = MAX_MESSAGE_SIZE, separator: str = "\n"):
+    """
+    Joins lines into messages that are at most max_size bytes (UTF-8 encoded) long
+
+    Lines are consumed lazily, so lines can be produced by a generator without building the whole reply in memory.
+    A single line longer than max_size is yielded as its own message.
+
+    :param lines: An iterable of strings
+    :param max_size: The maximal size of a message in bytes
+    :param separator: The string put between two lines of the same message
+    :return: A generator of messages
+    """
+    separator_size = len(separator.encode())
+    chunk = []
+    chunk_size = 0
+    for line in lines:
+        line_size = len(line.encode())
+        if chunk and chunk_size + separator_size + line_size > max_size:
+            yield separator.join(chunk)
+            chunk = []
+            chunk_size = 0
+        if chunk:
+            chunk_size += separator_size
+        chunk.append(line)
+        chunk_size += line_size
+    if chunk:
+        yield separator.join(chunk)
+
+
+async def send_reply(matrix_bot, room_id: str, lines, separator: str = "\n", title: str = "", code_block: bool = False,
+                     filename: str = "reply.txt", mimetype: str = "text/plain"):
+    """
+    Sends a reply that might not fit into a single Matrix event
+
+    The lines are joined into messages below MAX_MESSAGE_SIZE, which are sent one after another so they arrive in
+    order. A reply that needs more than MAX_MESSAGES_PER_REPLY messages is uploaded as a file instead.
+
+    :param matrix_bot: The simplematrixbotlib.Bot to send with
+    :param lines: An iterable of strings, see chunk_lines
+    :param title: Markdown put in front of the first message
+    :param code_block: Put each message into a code block. The file only contains the lines.
+    :param filename: Name of the file the reply is uploaded as
+    :param mimetype: Type of the file the reply is uploaded as
+    """
+    overhead = len(title.encode()) + (len("```\n\n```") if code_block else 0)
+    chunks = chunk_lines(lines, MAX_MESSAGE_SIZE - overhead, separator)
+    messages = list(itertools.islice(chunks, MAX_MESSAGES_PER_REPLY + 1))
+    if len(messages) > MAX_MESSAGES_PER_REPLY:
+        messages += chunks
+        data = separator.join(messages).encode()
+        if await send_file(matrix_bot, room_id, data, filename, mimetype, title):
+            return
+    for message in messages:
+        if code_block:
+            message = f"```\n{message}\n```"
+        async with get_send_slots():
+            await matrix_bot.api.send_markdown_message(room_id, f"{title}{message}")
+        title = ""
+
+
+async def send_file(matrix_bot, room_id: str, data: bytes, filename: str, mimetype: str, title: str = ""):
+    """
+    Uploads data and sends it as a file message, encrypted if the bot uses encryption
+
+    :return: True if the file was sent, False if the upload failed
+    """
+    async with get_send_slots():
+        response, keys = await matrix_bot.async_client.upload(io.BytesIO(data), content_type=mimetype,
+                                                              filename=filename, filesize=len(data),
+                                                              encrypt=matrix_bot.config.encryption_enabled)
+    content_uri = getattr(response, "content_uri", None)
+    if content_uri is None:
+        logging.warning("Could not upload %s, sending it as messages: %s", filename, response)
+        return False
+    content = {"msgtype": "m.file", "body": filename, "info": {"mimetype": mimetype, "size": len(data)}}
+    if matrix_bot.config.encryption_enabled:
+        content["file"] = {"url": content_uri, "key": keys["key"], "iv": keys["iv"], "hashes": keys["hashes"],
+                           "v": keys["v"]}
+    else:
+        content["url"] = content_uri
+    async with get_send_slots():
+        await matrix_bot.api.send_markdown_message(room_id, f"{title}The reply is too long, see {filename}")
+        await matrix_bot.async_client.room_send(room_id, "m.room.message", content,
+                                                ignore_unverified_devices=matrix_bot.config.ignore_unverified_devices)
+    return True
@@ -0,0 +1,128 @@
+"""
+Minimal Prometheus style metrics for the bot
+
+The metrics are kept in memory and can be exposed in the Prometheus text format via a small aiohttp server, so no
+additional dependency is needed.
+"""
+import bisect
+import logging
+from aiohttp import web
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(label_names, label_values, extra=()):
+    labels = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    labels += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    @staticmethod
+    def key(label_values):
+        # Label values are strings in the exposition, converting them keeps the keys sortable when a label mixes
+        # types, like the status code and "error"
+        return tuple(str(value) for value in label_values)
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.label_names, label_values)} {value}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        label_values = self.key(label_values)
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, *label_values, value: float):
+        self.values[self.key(label_values)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value: float):
+        label_values = self.key(label_values)
+        try:
+            bucket_counts, total = self.values[label_values]
+        except KeyError:
+            bucket_counts, total = [0] * (len(self.buckets) + 1), 0
+        bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[label_values] = (bucket_counts, total + value)
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for label_values, (bucket_counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+commands_total = Counter("registration_bot_commands_total",
+                         "Bot commands handled, by command and outcome (ok, denied, rate-limited, error)",
+                         ["command", "outcome"])
+command_duration = Histogram("registration_bot_command_duration_seconds",
+                             "Time to handle a bot command including all replies", ["command"])
+api_requests_total = Counter("registration_bot_admin_api_requests_total",
+                             "Requests sent to the admin API, by HTTP method and status code (or error)",
+                             ["method", "status"])
+api_request_duration = Histogram("registration_bot_admin_api_request_duration_seconds",
+                                 "Duration of admin API requests", ["method"])
+tokens = Gauge("registration_bot_tokens",
+               "Registration tokens at the last full list, by homeserver (admin API base URL) and state",
+               ["server", "state"])
+
+ALL_METRICS = [commands_total, command_duration, api_requests_total, api_request_duration, tokens]
+
+
+def expose():
+    """
+    :return: All metrics in the Prometheus text format
+    """
+    return "\n".join(line for metric in ALL_METRICS for line in metric.expose()) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=expose(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str = "127.0.0.1", port: int = 9100):
+    """
+    Starts serving the metrics on http://host:port/metrics
+
+    :return: The aiohttp.web.AppRunner, call its cleanup() method to stop the server
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+from matrix_registration_bot import logs
+from matrix_registration_bot.registration_api import RegistrationAPI
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class TokenNotifier:
+    """
+    Notifies the admins about tokens that expire or run out of uses and keeps enough valid tokens available
+
+    The notifier works on the token index of a RegistrationAPI and does not poll the homeserver itself. Upcoming
+    expiry times are kept in a heap, so the notifier sleeps until the next token expires (or should be warned about)
+    or until the token index changes. Uses of tokens are only noticed when the token index is refreshed, e.g. by a
+    list command, the purge or the statistics. Nothing is counted before all tokens were listed once, as a partly
+    filled index would trigger refills for tokens that exist.
+    """
+
+    def __init__(self, api: RegistrationAPI, send, expiry_warning: float = 24 * 3600, low_stock: int = 0,
+                 refill: int = 0, refill_expiry_days=7, refill_uses_allowed=1, list_retry_interval: float = 60):
+        """
+        :param api: The admin API whose tokens are watched
+        :param send: Coroutine function that posts a markdown message to the admins
+        :param expiry_warning: Warn this many seconds before a token expires, 0 to disable the warnings
+        :param low_stock: Alert when fewer valid tokens are available, 0 to disable the alert
+        :param refill: Create tokens when fewer valid tokens are available, 0 to disable the refill
+        :param list_retry_interval: Seconds between two attempts to list all tokens until it worked once
+        """
+        self.api = api
+        self.send = send
+        self.expiry_warning = int(expiry_warning * 1000)
+        self.low_stock = low_stock
+        self.refill = refill
+        self.refill_expiry_days = refill_expiry_days
+        self.refill_uses_allowed = refill_uses_allowed
+        # (time in ms, event, token) with event being "expiring" or "expired"
+        self.heap = []
+        self.states = {}
+        self.warned = set()
+        self.valid_tokens = 0
+        self.low_stock_alerted = False
+        self.list_retry_interval = list_retry_interval
+        # Whether the token index contained all tokens at some point
+        self.index_complete = False
+        self.changed = asyncio.Event()
+
+    def rescan(self, now: int):
+        """
+        Compares all tokens in the index with their last known state and rebuilds the heap
+
+        :return: List of notifications
+        """
+        messages = []
+        states = {}
+        self.heap = []
+        for token, token_details in self.api.token_index.items():
+            state = RegistrationAPI.token_state(token_details, now)
+            if self.states.get(token) == "valid" and state != "valid":
+                messages.append(self.state_message(token_details, state))
+            states[token] = state
+            if state != "valid" or token_details['expiry_time'] is None:
+                continue
+            expiry_time = token_details['expiry_time']
+            if self.expiry_warning > 0 and token not in self.warned:
+                self.heap.append((max(now, expiry_time - self.expiry_warning), "expiring", token))
+            self.heap.append((expiry_time, "expired", token))
+        heapq.heapify(self.heap)
+        self.states = states
+        self.warned &= states.keys()
+        self.valid_tokens = sum(1 for state in states.values() if state == "valid")
+        return messages
+
+    def process_due(self, now: int):
+        """
+        Handles the events of the heap that are due
+
+        :return: List of notifications
+        """
+        messages = []
+        while self.heap and self.heap[0][0] <= now:
+            _, event, token = heapq.heappop(self.heap)
+            token_details = self.api.token_index.get(token)
+            if token_details is None or self.states.get(token) != "valid":
+                continue
+            state = RegistrationAPI.token_state(token_details, now)
+            if event == "expiring" and state == "valid" and token not in self.warned:
+                self.warned.add(token)
+                messages.append(self.expiring_message(token_details))
+            elif state != "valid":
+                self.states[token] = state
+                self.valid_tokens -= 1
+                messages.append(self.state_message(token_details, state))
+        return messages
+
+    @staticmethod
+    def expiring_message(token_details):
+        expiry = datetime.utcfromtimestamp(token_details['expiry_time'] / 1000).strftime("%d.%m.%y %H:%M UTC")
+        return f"Token {RegistrationAPI.token_to_short_markdown(token_details)} expires at {expiry}"
+
+    @staticmethod
+    def state_message(token_details, state):
+        token = RegistrationAPI.token_to_short_markdown(token_details)
+        return f"Token {token} expired" if state == "expired" else f"Token {token} is used up"
+
+    async def check_stock(self):
+        """
+        Alerts about a low number of valid tokens and creates new ones if refill is enabled
+
+        :return: List of notifications
+        """
+        messages = []
+        if self.low_stock > 0 and self.valid_tokens < self.low_stock:
+            if not self.low_stock_alerted:
+                self.low_stock_alerted = True
+                messages.append(f"Only {self.valid_tokens} valid token(s) left")
+        else:
+            self.low_stock_alerted = False
+        if self.refill > self.valid_tokens:
+            count = self.refill - self.valid_tokens
+            created_tokens, errors = await self.api.create_tokens(count, self.refill_expiry_days,
+                                                                  self.refill_uses_allowed)
+            for error in errors:
+                logging.warning("Could not create a token to refill %s: %s", self.api.base_url, error)
+            if created_tokens:
+                tokens = ", ".join(RegistrationAPI.token_to_short_markdown(token) for token in created_tokens)
+                messages.append(f"Created {len(created_tokens)} token(s) to keep {self.refill} valid tokens "
+                                f"available: {tokens}")
+        return messages
+
+    async def list_all_tokens(self):
+        """
+        :return: True if all tokens were listed
+        """
+        try:
+            await self.api.list_tokens()
+            return True
+        except (ConnectionError, PermissionError, FileNotFoundError) as e:
+            logging.warning("Could not list the tokens of %s for notifications, retrying in %ss: %s",
+                            self.api.base_url, self.list_retry_interval, e)
+            return False
+
+    async def run(self):
+        self.api.index_listeners.append(self.changed.set)
+        try:
+            self.index_complete = await self.list_all_tokens()
+            while True:
+                timeout = None
+                if not self.index_complete:
+                    timeout = self.list_retry_interval
+                elif self.heap:
+                    timeout = max(0, (self.heap[0][0] - now_ms()) / 1000)
+                timed_out = False
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                logs.request_id.set(f"notify-{logs.new_request_id()}")
+                if not self.index_complete:
+                    # Single tokens looked up by a command do not complete the index, only listing all tokens does
+                    if self.api.token_index_updated is None and not (timed_out and await self.list_all_tokens()):
+                        self.changed.clear()
+                        continue
+                    self.index_complete = True
+                    self.changed.set()
+                now = now_ms()
+                if self.changed.is_set():
+                    self.changed.clear()
+                    messages = self.rescan(now)
+                else:
+                    messages = self.process_due(now)
+                try:
+                    messages += await self.check_stock()
+                except (ConnectionError, PermissionError, FileNotFoundError) as e:
+                    logging.warning("Could not refill tokens on %s: %s", self.api.base_url, e)
+                if messages:
+                    try:
+                        await self.send("\n".join(f"* {message}" for message in messages))
+                    except Exception as e:
+                        logging.error("Could not send token notifications: %s", e)
+        finally:
+            self.api.index_listeners.remove(self.changed.set)
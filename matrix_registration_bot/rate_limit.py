@@ -0,0 +1,76 @@
+import time
+
+
+class TokenBucket:
+    """
+    A token bucket that holds up to burst tokens and is refilled with rate tokens per second
+
+    Each command takes one token. If the bucket is empty, the command is rejected.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float = None):
+        """
+        :return: True if a token was taken, False if the bucket is empty
+        """
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_in(self):
+        """
+        :return: Seconds until the next token is available
+        """
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+class RateLimiter:
+    """
+    Keeps one token bucket per key (e.g. per user or per room)
+
+    Buckets that are full again are dropped, so the number of buckets does not grow with the number of users the bot
+    has ever seen.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.last_cleanup = time.monotonic()
+
+    def allow(self, key, now: float = None):
+        """
+        :param key: The key to rate limit, e.g. a user ID
+        :return: Tuple of (True if the request is allowed, seconds until the next request would be allowed)
+        """
+        if now is None:
+            now = time.monotonic()
+        self.cleanup(now)
+        try:
+            bucket = self.buckets[key]
+        except KeyError:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            bucket.updated = now
+        allowed = bucket.take(now)
+        return allowed, 0.0 if allowed else bucket.retry_in()
+
+    def cleanup(self, now: float):
+        """Drops all buckets that would be full by now, at most once per minute"""
+        if now - self.last_cleanup < 60:
+            return
+        self.last_cleanup = now
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
@@ -1,38 +1,124 @@
+import asyncio
 import logging
+import random
 import re
+import secrets
+import string
+import time
 from datetime import datetime, timedelta
 import aiohttp
+from matrix_registration_bot import metrics
+from matrix_registration_bot.circuit_breaker import CircuitBreaker
+from matrix_registration_bot.token_store import TokenStore
 
 
 class RegistrationAPI:
     def __init__(self, base_url: str, api_token: str = "", username: str = "", password: str = "",
-                 device_ID: str = "matrix-registration-bot"):
+                 device_ID: str = "matrix-registration-bot", max_concurrency: int = 10, cache_ttl: float = 30,
+                 connection_limit: int = 10, keepalive_timeout: float = 30, dns_cache_ttl: int = 300,
+                 connect_timeout: float = 10, read_timeout: float = 60, max_retries: int = 5,
+                 circuit_failure_threshold: int = 5, circuit_reset_timeout: float = 30, token_store: TokenStore = None):
         self.base_url = base_url
         self.api_token = api_token
         self.username = username
         self.password = password
         self.device_ID = device_ID
         self.headers = {"Authorization": f"Bearer {api_token}"}
+        # Keeps the API token obtained by logging in for the next start. A running login is shared by all requests.
+        self.token_store = token_store
+        self.login_task = None
         self.session = None
+        # Settings of the connection pool shared by all requests of this API connection
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        # Upper bound for the number of admin API requests a bulk operation keeps in flight
+        self.max_concurrency = max(1, int(max_concurrency))
+        # How often a request is retried before giving up. Requests are retried if they were rate limited (429) or,
+        # for idempotent requests, if the server could not be reached or returned a server error (5xx).
+        self.max_retries = max_retries
+        # Upper bound for a single backoff delay in seconds
+        self.max_backoff = 30
+        self.circuit_breaker = CircuitBreaker(base_url, circuit_failure_threshold, circuit_reset_timeout)
+        # Tasks of the GET requests currently in flight, by (path, authenticated)
+        self.requests_in_flight = {}
         self.registration_token_endpoint = '/_synapse/admin/v1/registration_tokens'
+        # In-memory index of token_details keyed by the token value. It is filled by list_tokens and kept up to date by
+        # the create and delete calls. After cache_ttl seconds it is considered stale and fetched again.
+        self.cache_ttl = float(cache_ttl)
+        self.token_index = {}
+        self.token_index_updated = None
+        # Functions without arguments that are called whenever the token index changes
+        self.index_listeners = []
 
     def __str__(self):
         return f"API Connection to {self.base_url}"
 
     async def ensure_api_token(self):
         if len(self.api_token) == 0:
-            assert len(self.password) > 0 and len(self.username) > 0
-            logging.info("Fetching a new API token using user/password combination of the bot")
-            self.api_token = await self.get_api_token(self.username, self.password, self.device_ID)
-            self.headers = {"Authorization": f"Bearer {self.api_token}"}
+            await self.refresh_api_token("")
+
+    def can_login(self):
+        return len(self.password) > 0 and len(self.username) > 0
+
+    def set_api_token(self, api_token: str):
+        self.api_token = api_token
+        self.headers = {"Authorization": f"Bearer {api_token}"}
+
+    async def refresh_api_token(self, rejected_token: str):
+        """
+        Obtains a new API token unless another request already replaced the rejected one
+
+        Concurrent calls share a single login.
+
+        :param rejected_token: The token the homeserver did not accept, "" if there is no token yet
+        """
+        if self.api_token != rejected_token:
+            return
+        if self.login_task is None:
+            self.login_task = asyncio.ensure_future(self.login(use_stored=rejected_token == ""))
+            self.login_task.add_done_callback(lambda done: setattr(self, "login_task", None))
+        # A cancelled caller must not cancel the login the other callers wait for
+        await asyncio.shield(self.login_task)
+
+    async def login(self, use_stored: bool = True):
+        assert self.can_login()
+        key = TokenStore.key(self.base_url, self.username)
+        if use_stored and self.token_store is not None:
+            try:
+                stored_token = await asyncio.to_thread(self.token_store.load, key)
+            except (OSError, ValueError) as e:
+                logging.warning("Could not read the stored API token from %s: %s", self.token_store.path, e)
+                stored_token = None
+            if stored_token:
+                logging.info("Reusing the stored API token for %s", self.base_url)
+                self.set_api_token(stored_token)
+                return
+        logging.info("Fetching a new API token using user/password combination of the bot")
+        self.set_api_token(await self.get_api_token(self.username, self.password, self.device_ID))
+        if self.token_store is not None:
+            try:
+                await asyncio.to_thread(self.token_store.save, key, self.api_token)
+            except OSError as e:
+                logging.warning("Could not store the API token in %s: %s", self.token_store.path, e)
 
     async def ensure_session(self):
-        if self.session is None:
-            self.session = aiohttp.ClientSession(self.base_url)
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.connection_limit,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=self.dns_cache_ttl)
+            self.session = aiohttp.ClientSession(self.base_url, connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        """Closes the session and all pooled connections. A later request opens a new session."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
 
     async def ensure_api(self):
         await self.ensure_session()
-        logging.debug(f"Session: {self.session}")
+        logging.debug("Session: %s", self.session)
         await self.ensure_api_token()
 
     async def get_api_token(self, username, password, device_ID):
@@ -42,10 +128,126 @@ class RegistrationAPI:
                 "password": f"{password}",
                 "type": "m.login.password",
                 "device_id": f"{device_ID}"}
-        async with self.session.post(f"/_matrix/client/r0/login", json=data) as r:
-            self.check_response(r)
-            response = await r.json()
-            return response["access_token"]
+        response = await self.request("POST", "/_matrix/client/v3/login", authenticated=False, json=data)
+        return response["access_token"]
+
+    def backoff_delay(self, attempt: int):
+        """
+        :return: An exponential backoff delay with full jitter for the given (zero based) retry attempt
+        """
+        return random.uniform(0, min(self.max_backoff, 0.5 * 2 ** attempt))
+
+    async def retry_delay(self, r, attempt: int):
+        """
+        Determines how long to wait before retrying a rate limited (429) request
+
+        The delay announced by the homeserver via retry_after_ms is preferred, otherwise an exponential backoff with
+        jitter is used. Announced delays above max_backoff are returned as well, send_request gives up on them.
+        """
+        try:
+            return (await r.json())["retry_after_ms"] / 1000
+        except (aiohttp.ContentTypeError, ValueError, KeyError, TypeError):
+            return self.backoff_delay(attempt)
+
+    async def request(self, method: str, path: str, authenticated: bool = True, **kwargs):
+        """
+        Sends a request to the homeserver and returns the decoded JSON response
+
+        Identical GET requests that are sent while the first one is still in flight share its response instead of
+        sending another request (single-flight). See send_request for the retry behaviour.
+
+        :param method: The HTTP method
+        :param path: The path relative to the base_url
+        :param authenticated: Whether to send the admin API token
+        :param kwargs: Passed to aiohttp.ClientSession.request
+        :return: The decoded JSON response
+        """
+        if method != "GET" or kwargs:
+            return await self.send_request(method, path, authenticated, **kwargs)
+        key = (path, authenticated)
+        task = self.requests_in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.send_request(method, path, authenticated))
+            self.requests_in_flight[key] = task
+            task.add_done_callback(lambda done: self.requests_in_flight.pop(key, None))
+        else:
+            logging.debug("Joining in-flight request GET: %s", path)
+        # A cancelled caller must not cancel the request the other callers wait for
+        return await asyncio.shield(task)
+
+    async def send_request(self, method: str, path: str, authenticated: bool = True, **kwargs):
+        """
+        Sends a request to the homeserver and returns the decoded JSON response
+
+        Rate limited requests are retried after the delay requested by the server, unless it is longer than max_backoff.
+        GET and DELETE requests are also retried with an exponential backoff if the server is unreachable or returns a
+        server error. While the circuit breaker is open, requests fail immediately. If the API token is rejected and the
+        credentials are known, the request is retried once after logging in again.
+
+        :param method: The HTTP method
+        :param path: The path relative to the base_url
+        :param authenticated: Whether to send the admin API token
+        :param kwargs: Passed to aiohttp.ClientSession.request
+        :return: The decoded JSON response
+        :raises FileNotFoundError, PermissionError, ConnectionError: see check_response
+        """
+        if authenticated:
+            await self.ensure_api()
+            kwargs["headers"] = self.headers
+        else:
+            await self.ensure_session()
+        idempotent = method in ("GET", "DELETE")
+        logged_in_again = False
+        for attempt in range(self.max_retries + 1):
+            retry = attempt < self.max_retries
+            trial = self.circuit_breaker.before_request()
+            start = time.monotonic()
+            used_token = self.api_token
+            try:
+                async with self.session.request(method, path, **kwargs) as r:
+                    duration = time.monotonic() - start
+                    metrics.api_requests_total.inc(method, r.status)
+                    metrics.api_request_duration.observe(method, value=duration)
+                    logging.debug("%s %s returned %s in %.0f ms", method, path, r.status, duration * 1000)
+                    if r.status >= 500:
+                        self.circuit_breaker.record_failure()
+                    else:
+                        self.circuit_breaker.record_success()
+                    if r.status == 401 and authenticated and retry and not logged_in_again and self.can_login():
+                        logged_in_again = True
+                        delay = None
+                    elif r.status == 429 and retry:
+                        delay = await self.retry_delay(r, attempt)
+                        if delay > self.max_backoff:
+                            # Waiting that long would stall the command, so the wait time is reported instead
+                            raise ConnectionError(f"{self.verbose_response(r)} The homeserver asks to wait "
+                                                  f"{delay:.0f}s before the next request")
+                    elif r.status >= 500 and idempotent and retry:
+                        delay = self.backoff_delay(attempt)
+                    else:
+                        self.check_response(r)
+                        return await r.json()
+                    if delay is not None:
+                        logging.info("%s, retrying in %.2fs", self.verbose_response(r), delay)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                metrics.api_requests_total.inc(method, "error")
+                self.circuit_breaker.record_failure()
+                if not (idempotent and retry):
+                    raise ConnectionError(f"Could not reach the registration api for {method}: {path} ({e!r})") from e
+                delay = self.backoff_delay(attempt)
+                logging.info("Could not reach the registration api for %s: %s (%r), retrying in %.2fs", method, path, e,
+                             delay)
+            except BaseException:
+                # Without this a cancelled trial request would keep the breaker half-open forever
+                if trial:
+                    self.circuit_breaker.release_trial()
+                raise
+            if delay is None:
+                logging.info("The API token for %s was rejected, logging in again", self.base_url)
+                await self.refresh_api_token(used_token)
+                kwargs["headers"] = self.headers
+            else:
+                await asyncio.sleep(delay)
 
     @staticmethod
     def verbose_response(r):
@@ -61,6 +263,51 @@ class RegistrationAPI:
         elif r.status != 200:
             raise ConnectionError(RegistrationAPI.verbose_response(r))
 
+    @staticmethod
+    def uses_left(token_details: dict):
+        """
+        :param token_details: A dictionary containing the token
+        :return: How often the token can still be used (pending registrations count as used), None if unlimited
+        """
+        if token_details['uses_allowed'] is None:
+            return None
+        return token_details['uses_allowed'] - (token_details['completed'] + token_details['pending'])
+
+    @staticmethod
+    def token_state(token_details: dict, now: int = None):
+        """
+        Determines whether a token can still be used to register
+
+        :param token_details: A dictionary containing the token
+        :param now: The current time as unix timestamp in milliseconds, defaults to the current time
+        :return: "expired", "used-up" or "valid"
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+        if token_details['expiry_time'] is not None and token_details['expiry_time'] <= now:
+            return "expired"
+        uses_left = RegistrationAPI.uses_left(token_details)
+        if uses_left is not None and uses_left <= 0:
+            return "used-up"
+        return "valid"
+
+    @staticmethod
+    def token_is_dead(token_details: dict, now: int = None):
+        """
+        Checks if a token can never be used again
+
+        Unlike token_state, pending registrations do not count as used: they might still fail and free the use again.
+
+        :param token_details: A dictionary containing the token
+        :param now: The current time as unix timestamp in milliseconds, defaults to the current time
+        :return: True if the token is expired or all allowed uses are completed
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+        if token_details['expiry_time'] is not None and token_details['expiry_time'] <= now:
+            return True
+        return token_details['uses_allowed'] is not None and token_details['completed'] >= token_details['uses_allowed']
+
     @staticmethod
     def token_to_markdown(token_details: dict):
         """
@@ -74,10 +321,9 @@ class RegistrationAPI:
                       'expiry_time': 1642807497388}
         :return: a string in markdown format
         """
-        if token_details['uses_allowed'] is None:
+        uses_left = RegistrationAPI.uses_left(token_details)
+        if uses_left is None:
             uses_left = "Unlimited"
-        else:
-            uses_left = token_details['uses_allowed'] - (token_details['completed'] + token_details['pending'])
         if token_details['expiry_time'] is None:
             timestamp = "Does not expire"
         else:
@@ -121,31 +367,62 @@ class RegistrationAPI:
         match = re.fullmatch(pattern, token)
         return match
 
-    async def list_tokens(self):
+    def token_index_is_fresh(self):
+        """
+        :return: True if the token index was fully populated less than cache_ttl seconds ago
+        """
+        return (self.token_index_updated is not None and
+                time.monotonic() - self.token_index_updated < self.cache_ttl)
+
+    def token_index_changed(self):
+        for listener in self.index_listeners:
+            listener()
+
+    def invalidate_token_index(self):
+        """Marks the token index as stale so the next list_tokens call fetches all tokens again"""
+        self.token_index_updated = None
+
+    def update_token_metrics(self, token_list):
+        now = int(time.time() * 1000)
+        states = {"valid": 0, "expired": 0, "used-up": 0}
+        for token_details in token_list:
+            states[RegistrationAPI.token_state(token_details, now)] += 1
+        metrics.tokens.set(self.base_url, "total", value=len(token_list))
+        for state, count in states.items():
+            metrics.tokens.set(self.base_url, state, value=count)
+
+    async def list_tokens(self, use_cache: bool = True):
         """
         Gathers a list of all registration tokens
 
+        :param use_cache: If True, the token index is used as long as it is fresh
         :return: List of token_details
         """
-        await self.ensure_api()
-        async with self.session.get(self.registration_token_endpoint, headers=self.headers) as r:
-            try:
-                assert r.status == 200
-            except AssertionError:
-                raise ConnectionError(self.verbose_response(r))
-            return (await r.json())["registration_tokens"]
+        if use_cache and self.token_index_is_fresh():
+            logging.debug("Serving token list from the token index")
+            return list(self.token_index.values())
+        token_list = (await self.request("GET", self.registration_token_endpoint))["registration_tokens"]
+        self.token_index = {token_details["token"]: token_details for token_details in token_list}
+        self.token_index_updated = time.monotonic()
+        self.update_token_metrics(token_list)
+        self.token_index_changed()
+        return token_list
 
     async def get_token(self, token):
         """
         Gets token
 
+        Tokens are served from the token index if it is fresh, otherwise they are fetched from the homeserver.
+
         :return: token_details as dict
         """
-        await self.ensure_api()
         if self.valid_token_format(token):
-            async with self.session.get(self.registration_token_endpoint + f"/{token}", headers=self.headers) as r:
-                self.check_response(r)
-                return await r.json()
+            if self.token_index_is_fresh() and token in self.token_index:
+                return self.token_index[token]
+            token_details = await self.request("GET", f"{self.registration_token_endpoint}/{token}")
+            self.token_index[token] = token_details
+            self.token_index_changed()
+            return token_details
         else:
             raise TypeError("Token is not a valid format!")
 
@@ -153,43 +430,215 @@ class RegistrationAPI:
         """
         Deletes all token
 
-        :return: List of deleted token
+        The token details returned by the list call are reused, so each token only costs a single DELETE request.
+
+        :return: Tuple of (list of deleted token_details, list of (token, error) for tokens that could not be deleted)
         """
         await self.ensure_api()
-        all_tokens = await self.list_tokens()
-        for token in all_tokens:
-            await self.delete_token(token["token"])
-        return all_tokens
+        all_tokens = await self.list_tokens(use_cache=False)
+        return await self.delete_tokens(all_tokens)
+
+    async def purge_tokens(self, dry_run: bool = False):
+        """
+        Deletes all tokens that are expired or completely used (see token_is_dead)
 
-    async def delete_token(self, token: str):
+        :param dry_run: If True, only determine which tokens would be deleted
+        :return: Tuple of (list of deleted token_details, list of (token, error) for tokens that could not be deleted)
+        """
+        now = int(time.time() * 1000)
+        dead_tokens = [token for token in await self.list_tokens(use_cache=False) if self.token_is_dead(token, now)]
+        if dry_run:
+            return dead_tokens, []
+        return await self.delete_tokens(dead_tokens)
+
+    async def delete_tokens(self, tokens: list):
+        """
+        Deletes the given tokens concurrently
+
+        At most max_concurrency requests are in flight at the same time. A failure to delete one token does not abort
+        the deletion of the others.
+
+        :param tokens: A list of token values (str) or token_details (dict). For token_details no additional GET request
+            is made to look up the token before it is deleted.
+        :return: Tuple of (list of deleted token_details, list of (token, error) for tokens that could not be deleted)
+        """
+        # delete_token logs in if needed, so a failed login is reported for each token instead of being raised
+        async def delete(token):
+            if isinstance(token, dict):
+                return await self.delete_token(token["token"], token_details=token)
+            return await self.delete_token(token)
+
+        deleted_tokens, failures = await self.gather_bounded(delete, tokens)
+        failed_tokens = [(token["token"] if isinstance(token, dict) else token, error) for token, error in failures]
+        return deleted_tokens, failed_tokens
+
+    async def gather_bounded(self, coroutine_function, items):
+        """
+        Calls coroutine_function for each item concurrently, with at most max_concurrency calls in flight
+
+        A failing call does not abort the others.
+
+        :return: Tuple of (list of results of the successful calls, list of (item, exception) for the failed calls)
+        """
+        items = list(items)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def call(item):
+            async with semaphore:
+                return await coroutine_function(item)
+
+        results = await asyncio.gather(*[call(item) for item in items], return_exceptions=True)
+        succeeded = []
+        failed = []
+        for item, result in zip(items, results):
+            if isinstance(result, Exception):
+                failed.append((item, result))
+            else:
+                succeeded.append(result)
+        return succeeded, failed
+
+    async def delete_token(self, token: str, token_details: dict = None):
         """
         Deletes the given token
 
         :param token:
+        :param token_details: The already known details of the token. If not given, they are fetched before deleting.
         :return: The token_details that is deleted as dict
         """
         await self.ensure_api()
         if self.valid_token_format(token):
-            r = await self.session.get(f"{self.registration_token_endpoint}/{token}", headers=self.headers)
-            self.check_response(r)
-            token_details = await r.json()
-            async with self.session.delete(f"{self.registration_token_endpoint}/{token}", headers=self.headers) as r:
-                self.check_response(r)
-                return token_details
+            if token_details is None:
+                token_details = await self.get_token(token)
+            try:
+                await self.request("DELETE", f"{self.registration_token_endpoint}/{token}")
+            except BaseException:
+                # The token may or may not be deleted, so the next list_tokens call asks the server
+                self.invalidate_token_index()
+                raise
+            self.token_index.pop(token, None)
+            self.token_index_changed()
+            return token_details
         else:
             raise ValueError(f"Token {token} is not a valid format!")
 
-    async def create_token(self, expiry_days=7):
+    @staticmethod
+    def generate_token_value(prefix: str = "", length: int = 16):
+        """
+        Generates a random token value
+
+        :param prefix: A string the token value starts with
+        :param length: The number of random characters appended to the prefix
+        :return: The token value as string
+        """
+        alphabet = string.ascii_letters + string.digits + "._~-"
+        token = prefix + "".join(secrets.choice(alphabet) for _ in range(length))
+        if not RegistrationAPI.valid_token_format(token):
+            raise ValueError(f"A prefix of {prefix} and a length of {length} do not result in a valid token format!")
+        return token
+
+    async def create_token(self, expiry_days=7, uses_allowed=1, length: int = None, token: str = None,
+                           expiry_time: int = None):
         """
         Create a token for registering a user
 
         expire_days:int
-            Determines how long the token will be valid (in days)
+            Determines how long the token will be valid (in days). None for a token that does not expire.
+        uses_allowed:int
+            How often the token can be used to register. None for unlimited uses.
+        length:int
+            The length of the token generated by the homeserver (default 16)
+        token:str
+            Use this value instead of letting the homeserver generate one
+        expiry_time:int
+            Expire the token at this unix timestamp in milliseconds instead of after expiry_days
         :return: token_details
         """
         await self.ensure_api()
-        expiry_time = int(datetime.timestamp(datetime.now() + timedelta(days=expiry_days)) * 1000)
-        data = '{"uses_allowed": 1, "expiry_time": ' + str(expiry_time) + '}'
-        async with self.session.post(f"{self.registration_token_endpoint}/new", data=data, headers=self.headers) as r:
-            self.check_response(r)
-            return await r.json()
+        data = {"uses_allowed": uses_allowed}
+        if expiry_time is not None:
+            data["expiry_time"] = expiry_time
+        elif expiry_days is None:
+            data["expiry_time"] = None
+        else:
+            data["expiry_time"] = int(datetime.timestamp(datetime.now() + timedelta(days=expiry_days)) * 1000)
+        if token is not None:
+            data["token"] = token
+        elif length is not None:
+            data["length"] = length
+        token_details = await self.request("POST", f"{self.registration_token_endpoint}/new", json=data)
+        self.token_index[token_details["token"]] = token_details
+        self.token_index_changed()
+        return token_details
+
+    async def create_tokens(self, count: int, expiry_days=7, uses_allowed=1, length: int = None, prefix: str = None):
+        """
+        Creates multiple tokens concurrently
+
+        At most max_concurrency requests are in flight at the same time. Rate limited requests are retried after the
+        delay requested by the homeserver.
+
+        :param count: The number of tokens to create
+        :param expiry_days: Determines how long the tokens will be valid (in days). None for no expiry.
+        :param uses_allowed: How often each token can be used. None for unlimited uses.
+        :param length: The length of the generated tokens. When a prefix is given, the length of the random part.
+        :param prefix: If given, token values are generated locally and start with this prefix
+        :return: Tuple of (list of created token_details, list of errors for tokens that could not be created)
+        """
+        await self.ensure_api()
+        if prefix is not None:
+            # Fail early instead of once for every token
+            self.generate_token_value(prefix, 16 if length is None else length)
+
+        async def create(_):
+            if prefix is None:
+                return await self.create_token(expiry_days, uses_allowed, length=length)
+            token = self.generate_token_value(prefix, 16 if length is None else length)
+            return await self.create_token(expiry_days, uses_allowed, token=token)
+
+        created_tokens, failures = await self.gather_bounded(create, range(count))
+        return created_tokens, [error for _, error in failures]
+
+    async def import_tokens(self, token_list, progress=None):
+        """
+        Creates tokens with the given values, remaining uses and expiry_time concurrently
+
+        Tokens that already exist on the homeserver are skipped, so an interrupted import can simply be started again.
+        Expired and used up tokens are skipped as they can not be used anymore. Pending and completed uses are
+        subtracted from the allowed uses, so a used token does not allow more registrations after the import.
+
+        :param token_list: An iterable of dictionaries with the token, uses_allowed, expiry_time and optionally pending
+            and completed
+        :param progress: Optional function called with (number of finished tokens, number of tokens to create)
+        :return: Tuple of (list of created token_details, list of skipped tokens, list of (token, error))
+        """
+        await self.ensure_api()
+        existing = {token_details["token"] for token_details in await self.list_tokens(use_cache=False)}
+        now = int(time.time() * 1000)
+        to_create = []
+        skipped = []
+        for token_details in token_list:
+            uses_allowed = token_details["uses_allowed"]
+            if uses_allowed is not None:
+                uses_allowed -= (token_details.get("pending") or 0) + (token_details.get("completed") or 0)
+            if (token_details["token"] in existing or
+                    (token_details["expiry_time"] is not None and token_details["expiry_time"] <= now) or
+                    (uses_allowed is not None and uses_allowed <= 0)):
+                skipped.append(token_details["token"])
+            else:
+                # Later duplicates within the import are skipped as well
+                existing.add(token_details["token"])
+                to_create.append(dict(token_details, uses_allowed=uses_allowed))
+        finished = 0
+
+        async def create(token_details):
+            nonlocal finished
+            try:
+                return await self.create_token(uses_allowed=token_details["uses_allowed"], token=token_details["token"],
+                                               expiry_days=None, expiry_time=token_details["expiry_time"])
+            finally:
+                finished += 1
+                if progress is not None:
+                    progress(finished, len(to_create))
+
+        created_tokens, failures = await self.gather_bounded(create, to_create)
+        return created_tokens, skipped, [(token_details["token"], error) for token_details, error in failures]
@@ -0,0 +1,133 @@
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT PRIMARY KEY,
+    uses_allowed INTEGER,
+    expiry_time INTEGER,
+    pending INTEGER NOT NULL,
+    completed INTEGER NOT NULL,
+    first_seen INTEGER NOT NULL,
+    last_changed INTEGER NOT NULL,
+    deleted_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS changes (
+    time INTEGER NOT NULL,
+    token TEXT NOT NULL,
+    event TEXT NOT NULL,
+    completed_delta INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_by_token ON changes (token, time);
+CREATE TABLE IF NOT EXISTS daily_registrations (
+    day TEXT PRIMARY KEY,
+    registrations INTEGER NOT NULL
+);
+"""
+
+
+class SnapshotStore:
+    """
+    Stores the history of the registration tokens in a SQLite database
+
+    Each snapshot (the result of a list_tokens call) is compared to the last known state of the tokens and only the
+    differences are stored as changes. The current state and the registrations per day are kept up to date with each
+    snapshot, so statistics do not need to scan the history.
+
+    All methods are blocking, use them via asyncio.to_thread from the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # The connection is used from worker threads, one at a time
+        self.lock = threading.Lock()
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, token_list, now: int = None):
+        """
+        Records a snapshot of all tokens
+
+        :param token_list: A list of token_details as returned by list_tokens
+        :param now: The time of the snapshot as unix timestamp in milliseconds, defaults to the current time
+        :return: The number of changes recorded
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+        day = datetime.fromtimestamp(now / 1000, timezone.utc).strftime("%Y-%m-%d")
+        changes = []
+        registrations = 0
+        with self.lock, self.connection:
+            known = {row[0]: row[1:] for row in self.connection.execute(
+                "SELECT token, uses_allowed, expiry_time, pending, completed FROM tokens WHERE deleted_at IS NULL")}
+            for token_details in token_list:
+                token = token_details['token']
+                state = (token_details['uses_allowed'], token_details['expiry_time'], token_details['pending'],
+                         token_details['completed'])
+                previous = known.pop(token, None)
+                if previous is None:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?, ?, NULL)",
+                        (token, *state, now, now))
+                    # Registrations that happened before the token was first seen can not be attributed to a day
+                    changes.append((now, token, "created", token_details['completed']))
+                elif previous != state:
+                    self.connection.execute(
+                        "UPDATE tokens SET uses_allowed = ?, expiry_time = ?, pending = ?, completed = ?, "
+                        "last_changed = ? WHERE token = ?", (*state, now, token))
+                    completed_delta = token_details['completed'] - previous[3]
+                    changes.append((now, token, "changed", completed_delta))
+                    registrations += completed_delta
+            for token in known:
+                self.connection.execute("UPDATE tokens SET deleted_at = ? WHERE token = ?", (now, token))
+                changes.append((now, token, "deleted", 0))
+            self.connection.executemany("INSERT INTO changes VALUES (?, ?, ?, ?)", changes)
+            if registrations:
+                self.connection.execute(
+                    "INSERT INTO daily_registrations VALUES (?, ?) "
+                    "ON CONFLICT (day) DO UPDATE SET registrations = registrations + excluded.registrations",
+                    (day, registrations))
+        logging.debug("Recorded token snapshot with %s changes", len(changes))
+        return len(changes)
+
+    def registrations_per_day(self, days: int = 14):
+        """
+        :return: List of (day as YYYY-MM-DD, number of completed registrations) for the last days with registrations
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT day, registrations FROM daily_registrations ORDER BY day DESC LIMIT ?", (days,)).fetchall()
+        return list(reversed(rows))
+
+    def conversion_rates(self, limit: int = 10):
+        """
+        The conversion rate of a token is the share of its allowed uses that resulted in a registration
+
+        :return: List of (token, completed, uses_allowed) of the existing tokens with the most registrations
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT token, completed, uses_allowed FROM tokens WHERE deleted_at IS NULL AND completed > 0 "
+                "ORDER BY completed DESC LIMIT ?", (limit,)).fetchall()
+
+    def nearly_exhausted(self, uses_left: int = 1, expires_within: int = 24 * 3600 * 1000, now: int = None):
+        """
+        :param uses_left: Tokens with at most this many uses left are included
+        :param expires_within: Tokens expiring within this many milliseconds are included
+        :return: List of (token, uses left or None, expiry_time) of the existing, still valid tokens that are
+            nearly used up or expire soon
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+        with self.lock:
+            return self.connection.execute(
+                "SELECT token, uses_allowed - completed - pending AS left, expiry_time FROM tokens "
+                "WHERE deleted_at IS NULL AND (expiry_time IS NULL OR expiry_time > ?) "
+                "AND (left IS NULL OR left > 0) AND (left <= ? OR expiry_time <= ?) ORDER BY expiry_time",
+                (now, uses_left, now + expires_within)).fetchall()
@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+import threading
+
+
+class TokenStore:
+    """
+    Keeps the admin API access tokens obtained by logging in, so they can be reused after a restart
+
+    The tokens of all homeservers are stored in one JSON file that only the owner can read. All methods are blocking,
+    use them via asyncio.to_thread from the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(base_url: str, username: str):
+        return f"{username}@{base_url}"
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def write(self, tokens: dict):
+        # mkstemp creates the file readable and writable by the owner only
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                              prefix=f".{os.path.basename(self.path)}.")
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(tokens, file)
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def load(self, key: str):
+        """
+        :return: The stored access token or None
+        """
+        with self.lock:
+            return self.read().get(key)
+
+    def save(self, key: str, access_token: str):
+        with self.lock:
+            tokens = self.read()
+            tokens[key] = access_token
+            self.write(tokens)
@@ -0,0 +1,92 @@
+"""Export and import of registration tokens as CSV or JSON Lines, e.g. for audits or to move tokens to a new server"""
+import csv
+import io
+import json
+from matrix_registration_bot.registration_api import RegistrationAPI
+
+FORMATS = ("csv", "jsonl")
+FIELDS = ("token", "uses_allowed", "pending", "completed", "expiry_time")
+
+
+def guess_format(path: str):
+    """
+    :return: "csv" for paths ending in .csv, else "jsonl"
+    """
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def export_lines(token_list, export_format: str = "jsonl"):
+    """
+    Converts tokens to lines of CSV (with a header) or JSON Lines
+
+    Lines are produced one by one, so a large export never has to be held in memory as one document.
+
+    :param token_list: An iterable of token_details
+    :param export_format: "csv" or "jsonl"
+    :return: A generator of lines without line breaks
+    """
+    if export_format == "jsonl":
+        for token_details in token_list:
+            yield json.dumps({field: token_details.get(field) for field in FIELDS})
+    elif export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="")
+
+        def to_line(values):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(["" if value is None else value for value in values])
+            return buffer.getvalue()
+
+        yield to_line(FIELDS)
+        for token_details in token_list:
+            yield to_line(token_details.get(field) for field in FIELDS)
+    else:
+        raise ValueError(f"Unknown format {export_format}, use one of {', '.join(FORMATS)}")
+
+
+def write_export(token_list, file, export_format: str = "jsonl"):
+    """
+    Writes tokens to an open text file
+
+    :return: The number of tokens written
+    """
+    lines = 0
+    for line in export_lines(token_list, export_format):
+        file.write(line + "\n")
+        lines += 1
+    header_lines = 1 if export_format == "csv" else 0
+    return lines - header_lines
+
+
+def parse_optional_int(value, line_number: int, field: str):
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Line {line_number}: {field} must be a number or empty, not {value!r}")
+
+
+def read_tokens(file, import_format: str = "jsonl"):
+    """
+    Reads tokens written by write_export from an open text file
+
+    :return: A generator of dictionaries with the token, uses_allowed, pending, completed and expiry_time. Missing
+        pending and completed uses are 0.
+    """
+    if import_format == "jsonl":
+        rows = ((line_number, json.loads(line)) for line_number, line in enumerate(file, 1) if line.strip())
+    elif import_format == "csv":
+        rows = enumerate(csv.DictReader(file), 2)
+    else:
+        raise ValueError(f"Unknown format {import_format}, use one of {', '.join(FORMATS)}")
+    for line_number, row in rows:
+        token = row.get("token")
+        if not token or not RegistrationAPI.valid_token_format(token):
+            raise ValueError(f"Line {line_number}: {token!r} is not a valid token")
+        yield {"token": token,
+               "uses_allowed": parse_optional_int(row.get("uses_allowed"), line_number, "uses_allowed"),
+               "pending": parse_optional_int(row.get("pending"), line_number, "pending") or 0,
+               "completed": parse_optional_int(row.get("completed"), line_number, "completed") or 0,
+               "expiry_time": parse_optional_int(row.get("expiry_time"), line_number, "expiry_time")}
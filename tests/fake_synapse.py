@@ -0,0 +1,157 @@
+import asyncio
+import random
+import time
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from matrix_registration_bot import bot
+from matrix_registration_bot.registration_api import RegistrationAPI
+
+REGISTRATION_TOKEN_ENDPOINT = "/_synapse/admin/v1/registration_tokens"
+
+
+def make_token(value, **details):
+    token = {"token": value, "uses_allowed": 1, "pending": 0, "completed": 0, "expiry_time": None}
+    token.update(details)
+    return token
+
+
+def make_token_table(size: int):
+    """
+    Generates a mix of valid, expired, used up and unlimited tokens
+
+    :param size: The number of tokens
+    :return: A list of token_details
+    """
+    now = int(time.time() * 1000)
+    tokens = []
+    for i in range(size):
+        if i % 4 == 0:
+            tokens.append(make_token(f"expired{i}", expiry_time=now - 1000))
+        elif i % 4 == 1:
+            tokens.append(make_token(f"usedup{i}", completed=1))
+        elif i % 4 == 2:
+            tokens.append(make_token(f"unlimited{i}", uses_allowed=None))
+        else:
+            tokens.append(make_token(f"valid{i}", expiry_time=now + 7 * 24 * 3600 * 1000))
+    return tokens
+
+
+class FakeSynapse:
+    """
+    An in-process stand-in for the Synapse login and registration token admin API
+
+    It can simulate a slow or unreliable homeserver: every request is delayed by latency seconds, a share of requests
+    (error_rate) fails with a 500 and another share (rate_limit_rate) is rate limited. For deterministic tests,
+    the next failing_requests and rate_limited_requests requests fail or are rate limited.
+    """
+
+    def __init__(self, tokens=(), access_token="secret", username="admin", password="password", latency: float = 0,
+                 error_rate: float = 0, rate_limit_rate: float = 0, retry_after_ms: int = 10, failing_requests=0,
+                 rate_limited_requests=0):
+        self.tokens = {token["token"]: token for token in tokens}
+        self.access_token = access_token
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.failing_requests = failing_requests
+        self.rate_limited_requests = rate_limited_requests
+        self.logins = 0
+        # (method, token) of every admin API request. token is None for list and create requests.
+        self.requests = []
+
+    def app(self):
+        app = web.Application(middlewares=[self.simulate_conditions])
+        for version in ["r0", "v3"]:
+            app.router.add_post(f"/_matrix/client/{version}/login", self.login)
+        app.router.add_get(REGISTRATION_TOKEN_ENDPOINT, self.list_tokens)
+        app.router.add_post(f"{REGISTRATION_TOKEN_ENDPOINT}/new", self.create_token)
+        app.router.add_get(REGISTRATION_TOKEN_ENDPOINT + "/{token}", self.get_token)
+        app.router.add_delete(REGISTRATION_TOKEN_ENDPOINT + "/{token}", self.delete_token)
+        return app
+
+    @web.middleware
+    async def simulate_conditions(self, request, handler):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if request.path.startswith(REGISTRATION_TOKEN_ENDPOINT):
+            token = request.match_info.get("token")
+            self.requests.append((request.method, None if token == "new" else token))
+            if request.headers.get("Authorization") != f"Bearer {self.access_token}":
+                return web.json_response({"errcode": "M_UNKNOWN_TOKEN"}, status=401)
+        if self.failing_requests > 0 or random.random() < self.error_rate:
+            self.failing_requests = max(0, self.failing_requests - 1)
+            return web.json_response({"errcode": "M_UNKNOWN"}, status=503)
+        if self.rate_limited_requests > 0 or random.random() < self.rate_limit_rate:
+            self.rate_limited_requests = max(0, self.rate_limited_requests - 1)
+            return web.json_response({"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": self.retry_after_ms},
+                                     status=429)
+        return await handler(request)
+
+    async def login(self, request):
+        data = await request.json()
+        if data["identifier"]["user"] != self.username or data["password"] != self.password:
+            return web.json_response({"errcode": "M_FORBIDDEN"}, status=403)
+        self.logins += 1
+        return web.json_response({"access_token": self.access_token, "device_id": data.get("device_id")})
+
+    async def list_tokens(self, request):
+        return web.json_response({"registration_tokens": list(self.tokens.values())})
+
+    async def create_token(self, request):
+        data = await request.json()
+        token = data.get("token", RegistrationAPI.generate_token_value(length=data.get("length", 16)))
+        if token in self.tokens:
+            return web.json_response({"errcode": "M_INVALID_PARAM"}, status=400)
+        self.tokens[token] = make_token(token, uses_allowed=data.get("uses_allowed"),
+                                        expiry_time=data.get("expiry_time"))
+        return web.json_response(self.tokens[token])
+
+    async def get_token(self, request):
+        token = request.match_info["token"]
+        if token not in self.tokens:
+            return web.json_response({"errcode": "M_NOT_FOUND"}, status=404)
+        return web.json_response(self.tokens[token])
+
+    async def delete_token(self, request):
+        if self.tokens.pop(request.match_info["token"], None) is None:
+            return web.json_response({"errcode": "M_NOT_FOUND"}, status=404)
+        return web.json_response({})
+
+    def server(self):
+        """
+        :return: An aiohttp TestServer serving the fake on a free local port, to be used as async context manager
+        """
+        return TestServer(self.app())
+
+
+class FakeEvent:
+    """A room message as passed to the message handler of the bot"""
+
+    def __init__(self, body, sender="@admin:example.com"):
+        self.body = body
+        self.sender = sender
+        self.formatted_body = None
+
+
+class FakeRoom:
+    def __init__(self, room_id="!room:example.com"):
+        self.room_id = room_id
+
+
+def setup_offline_bot(config, send=None):
+    """
+    Sets the bot up with the given Config without connecting to Matrix
+
+    :param send: Coroutine function replacing the functions sending messages, by default replies are discarded
+    """
+    bot.setup(config)
+
+    async def discard(*args, **kwargs):
+        pass
+
+    bot.bot.api.send_markdown_message = send or discard
+    bot.bot.api.send_text_message = send or discard
+    bot.bot.async_client = type("FakeClient", (), {"user_id": "@registration-bot:example.com"})
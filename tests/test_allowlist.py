@@ -0,0 +1,66 @@
+import asyncio
+import re
+from simplematrixbotlib import Config
+from matrix_registration_bot.allowlist import AllowlistMatcher, ConfigSaver, compile_patterns, save_atomically
+
+
+def test_compiled_patterns_match_like_single_regexes():
+    patterns = {re.compile(p) for p in ["@admin:example.com", "@mod[0-9]+:example.com", r"@.*:admin\.org"]}
+    matches = compile_patterns(patterns)
+    for user_id in ["@admin:example.com", "@mod1:example.com", "@x:admin.org", "@mod:example.com", "@x:admin.orgs",
+                    "@adminXexample.com"]:
+        assert matches(user_id) == any(p.fullmatch(user_id) for p in patterns)
+
+
+def test_patterns_with_backreferences_keep_their_groups():
+    patterns = {re.compile(p) for p in
+                [r"@(a+):\1\.org", r"@(?P<name>[a-z]+):(?P=name)\.com", "@mod[0-9]+:example.com"]}
+    matches = compile_patterns(patterns)
+    for user_id in ["@aa:aa.org", "@aa:a.org", "@bob:bob.com", "@bob:eve.com", "@mod1:example.com"]:
+        assert matches(user_id) == any(p.fullmatch(user_id) for p in patterns)
+
+
+def test_matcher_follows_config_changes():
+    config = Config()
+    matcher = AllowlistMatcher(config)
+    assert matcher.is_allowed("@anyone:example.com")
+    config.add_allowlist({"@admin:example.com", "@.*:admin.org"})
+    assert matcher.is_allowed("@admin:example.com") and matcher.is_allowed("@x:admin.org")
+    assert not matcher.is_allowed("@anyone:example.com")
+    config.blocklist = {"@x:admin.org"}
+    assert not matcher.is_allowed("@x:admin.org")
+    config.remove_allowlist({"@admin:example.com"})
+    assert not matcher.is_allowed("@admin:example.com")
+
+
+def test_changes_are_saved_once(tmp_path):
+    path = tmp_path / "config.toml"
+    config = Config()
+
+    async def scenario():
+        saver = ConfigSaver(config, str(path), delay=0.01)
+        config.add_allowlist({"@admin:example.com"})
+        saver.schedule()
+        config.add_allowlist({"@mod:example.com"})
+        saver.schedule()
+        assert not path.exists()
+        await asyncio.sleep(0.1)
+        modified = path.stat().st_mtime_ns
+        await saver.flush()
+        assert path.stat().st_mtime_ns == modified
+
+    asyncio.run(scenario())
+    saved = Config()
+    saved.load_toml(str(path))
+    assert {p.pattern for p in saved.allowlist} == {"@admin:example.com", "@mod:example.com"}
+    assert [p.name for p in tmp_path.iterdir()] == ["config.toml"]
+
+
+def test_saving_keeps_file_mode(tmp_path):
+    path = tmp_path / "config.toml"
+    config = Config()
+    config.save_toml(str(path))
+    path.chmod(0o640)
+    config.add_allowlist({"@admin:example.com"})
+    assert save_atomically(config, str(path))
+    assert path.stat().st_mode & 0o777 == 0o640
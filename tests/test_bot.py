@@ -0,0 +1,301 @@
+import asyncio
+import os
+import pytest
+import subprocess
+import sys
+import time
+import yaml
+from matrix_registration_bot import bot, metrics
+from matrix_registration_bot.config import Config
+from tests.fake_synapse import FakeEvent, FakeRoom, FakeSynapse, make_token, setup_offline_bot
+
+
+def test_import_has_no_side_effects():
+    code = ("import sys, matrix_registration_bot.bot as bot; "
+            "assert bot.bot is None and bot.api is None; "
+            "assert 'simplematrixbotlib' not in sys.modules and 'nio' not in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_version_command(capsys):
+    bot.run_bot(["version"])
+    assert capsys.readouterr().out.strip() == bot.matrix_registration_bot.__version__
+
+
+def test_help_is_generated_from_commands():
+    help_string = bot.generate_help_string()
+    for name, cmd in bot.commands.items():
+        assert f"* `{bot.bot_prefix}{name}" in help_string
+        assert cmd.help in help_string
+
+
+def test_failing_commands_are_measured(monkeypatch):
+    monkeypatch.setattr(bot, "allowlist_matcher", type("AllowAll", (), {"is_allowed": lambda self, sender: True})())
+    monkeypatch.setattr(bot, "user_rate_limiter", None)
+    monkeypatch.setattr(bot, "room_rate_limiter", None)
+
+    async def fail(match, room):
+        raise ConnectionError("unreachable")
+
+    handler = bot.allowed_required(fail, "failing-test")
+    match = type("FakeMatch", (), {"event": FakeEvent("failing-test")})
+    with pytest.raises(ConnectionError):
+        asyncio.run(handler(match, FakeRoom()))
+    bucket_counts, total = metrics.command_duration.values[("failing-test",)]
+    assert sum(bucket_counts) == 1
+    assert metrics.commands_total.values[("failing-test", "error")] == 1
+
+
+def setup_bot(monkeypatch, tmp_path, homeservers):
+    """Sets the bot up with the given homeserver configs and returns the list replies are collected in"""
+    monkeypatch.chdir(tmp_path)
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(yaml.safe_dump({"bot": {"server": homeservers[0]["base_url"], "username": "registration-bot",
+                                                   "access_token": "unused", "prefix": ""},
+                                           "homeservers": homeservers}))
+    replies = []
+
+    async def send(room_id, message, *args, **kwargs):
+        replies.append(message)
+
+    setup_offline_bot(Config(str(config_path)), send)
+    # Connections replaced by reloads of earlier tests are closed with the event loop of those tests
+    monkeypatch.setattr(bot, "replaced_apis", set())
+    monkeypatch.setattr(bot, "closing_tasks", set())
+    return replies
+
+
+def test_commands_target_homeservers(monkeypatch, tmp_path):
+    first = FakeSynapse([make_token("first")])
+    second = FakeSynapse([make_token("second")])
+
+    async def scenario():
+        async with first.server() as first_server, second.server() as second_server:
+            replies = setup_bot(monkeypatch, tmp_path, [
+                {"name": "one", "base_url": str(first_server.make_url("")), "token": first.access_token},
+                {"name": "two", "base_url": str(second_server.make_url("")), "token": second.access_token}])
+            try:
+                await bot.token_actions(FakeRoom(), FakeEvent("list"))
+                await bot.token_actions(FakeRoom(), FakeEvent("create @two"))
+                await bot.token_actions(FakeRoom(), FakeEvent("list all"))
+            finally:
+                await asyncio.gather(*[target_api.close() for target_api in bot.apis.values()])
+            return replies
+
+    replies = asyncio.run(scenario())
+    assert "`first`" in replies[0] and "second" not in replies[0]
+    assert len(first.tokens) == 1 and len(second.tokens) == 2
+    assert replies[2].startswith("**one**") and replies[3].startswith("**two**")
+
+
+def test_commands_are_rate_limited(monkeypatch, tmp_path):
+    fake = FakeSynapse([make_token("first")])
+
+    async def scenario():
+        async with fake.server() as server:
+            replies = setup_bot(monkeypatch, tmp_path, [{"base_url": str(server.make_url("")),
+                                                         "token": fake.access_token}])
+            bot.user_rate_limiter.rate, bot.user_rate_limiter.burst = 0.01, 2
+            try:
+                for _ in range(3):
+                    await bot.token_actions(FakeRoom(), FakeEvent("show first"))
+            finally:
+                await bot.api.close()
+            return replies
+
+    replies = asyncio.run(scenario())
+    assert len(fake.requests) <= 2
+    assert "too fast" in replies[-1]
+
+
+def test_reload_swaps_config_and_keeps_unchanged_connections(monkeypatch, tmp_path):
+    homeservers = [{"name": "one", "base_url": "http://one.example.com", "token": "secret"},
+                   {"name": "two", "base_url": "http://two.example.com", "token": "secret"}]
+    setup_bot(monkeypatch, tmp_path, homeservers)
+    config_path = tmp_path / "config.yml"
+    first, second = bot.apis["one"], bot.apis["two"]
+
+    async def reload(changed_config):
+        config_path.write_text(yaml.safe_dump(changed_config))
+        return bot.reload_config()
+
+    changed_config = yaml.safe_load(config_path.read_text())
+    changed_config["bot"]["prefix"] = "!reg "
+    changed_config["homeservers"][1]["token"] = "rotated"
+    assert asyncio.run(reload(changed_config))
+    assert bot.bot_prefix == "!reg " and "!reg list" in bot.help_string
+    assert bot.apis["one"] is first and bot.apis["two"] is not second
+    assert bot.apis["two"].api_token == "rotated"
+
+    changed_config["homeservers"].append(changed_config["homeservers"][0])
+    assert not asyncio.run(reload(changed_config))
+    assert bot.apis["one"] is first and bot.bot_prefix == "!reg "
+
+
+def test_unreadable_config_keeps_watching(monkeypatch, tmp_path):
+    setup_bot(monkeypatch, tmp_path, [{"base_url": "http://one.example.com", "token": "secret"}])
+    config_path = tmp_path / "config.yml"
+    config_path.unlink()
+    config_path.mkdir()
+    assert not bot.reload_config()
+
+    reloads = []
+
+    def reload_config():
+        reloads.append(len(reloads))
+        if len(reloads) == 1:
+            raise RuntimeError("unexpected")
+
+    async def watch():
+        watcher = asyncio.create_task(bot.watch_config_file(0.01))
+        await asyncio.sleep(0.05)
+        for modified in [1, 2]:
+            os.utime(config_path, ns=(modified, modified))
+            await asyncio.sleep(0.05)
+        watcher.cancel()
+
+    monkeypatch.setattr(bot, "reload_config", reload_config)
+    asyncio.run(watch())
+    assert len(reloads) == 2
+
+
+def test_delete_command(monkeypatch, tmp_path):
+    fake = FakeSynapse([make_token("first"), make_token("second")])
+
+    async def scenario():
+        async with fake.server() as server:
+            replies = setup_bot(monkeypatch, tmp_path, [{"base_url": str(server.make_url("")),
+                                                         "token": fake.access_token}])
+            try:
+                await bot.token_actions(FakeRoom(), FakeEvent("delete first missing"))
+            finally:
+                await bot.api.close()
+            return replies
+
+    replies = asyncio.run(scenario())
+    assert list(fake.tokens) == ["second"]
+    assert "`first`" in replies[0] and "`missing`" in replies[1]
+
+
+def test_show_reports_rejected_credentials(monkeypatch, tmp_path):
+    fake = FakeSynapse([make_token("first")])
+
+    async def scenario():
+        async with fake.server() as server:
+            replies = setup_bot(monkeypatch, tmp_path, [{"base_url": str(server.make_url("")), "token": "revoked",
+                                                         "token_store": ""}])
+            try:
+                await bot.token_actions(FakeRoom(), FakeEvent("show first"))
+            finally:
+                await bot.api.close()
+            return replies
+
+    replies = asyncio.run(scenario())
+    assert len(replies) == 1 and replies[0].startswith("The bot encountered the following error")
+
+
+def test_stats_per_homeserver(monkeypatch, tmp_path):
+    first = FakeSynapse([make_token("first", uses_allowed=5, completed=2)])
+    second = FakeSynapse([make_token("second", uses_allowed=5, completed=3)])
+
+    async def scenario():
+        async with first.server() as first_server, second.server() as second_server:
+            replies = setup_bot(monkeypatch, tmp_path, [
+                {"name": "one", "base_url": str(first_server.make_url("")), "token": first.access_token},
+                {"name": "two", "base_url": str(second_server.make_url("")), "token": second.access_token}])
+            monkeypatch.setattr(bot, "snapshot_stores", {})
+            monkeypatch.setattr(bot, "stats_path", str(tmp_path / "token_stats.sqlite"))
+            try:
+                await asyncio.gather(*[bot.record_snapshot(name, target_api) for name, target_api in bot.apis.items()])
+                await bot.token_actions(FakeRoom(), FakeEvent("stats"))
+                await bot.token_actions(FakeRoom(), FakeEvent("stats @two"))
+            finally:
+                await asyncio.gather(*[target_api.close() for target_api in bot.apis.values()])
+                for snapshot_store in bot.snapshot_stores.values():
+                    snapshot_store.close()
+            return replies
+
+    replies = asyncio.run(scenario())
+    assert replies[0].startswith("**one**") and "`first`: 2 of 5" in replies[0] and "second" not in replies[0]
+    assert replies[1].startswith("**two**") and "`second`: 3 of 5" in replies[1]
+    assert sorted(path.name for path in tmp_path.glob("*.sqlite")) == ["token_stats-two.sqlite", "token_stats.sqlite"]
+
+
+def test_delete_reports_failed_login(monkeypatch, tmp_path):
+    fake = FakeSynapse([make_token("first")])
+
+    async def scenario():
+        async with fake.server() as server:
+            replies = setup_bot(monkeypatch, tmp_path, [{"base_url": str(server.make_url("")), "username": "admin",
+                                                         "password": "wrong", "token_store": ""}])
+            try:
+                await bot.token_actions(FakeRoom(), FakeEvent("delete first"))
+            finally:
+                await bot.api.close()
+            return replies
+
+    replies = asyncio.run(scenario())
+    assert list(fake.tokens) == ["first"]
+    assert len(replies) > 0 and "`first`" in replies[-1]
+
+
+def test_create_all_calls_homeservers_concurrently(monkeypatch, tmp_path):
+    first = FakeSynapse(latency=0.2)
+    second = FakeSynapse(latency=0.2)
+
+    async def scenario():
+        async with first.server() as first_server, second.server() as second_server:
+            replies = setup_bot(monkeypatch, tmp_path, [
+                {"name": "one", "base_url": str(first_server.make_url("")), "token": first.access_token},
+                {"name": "two", "base_url": str(second_server.make_url("")), "token": second.access_token}])
+            try:
+                start = time.perf_counter()
+                await bot.token_actions(FakeRoom(), FakeEvent("create all"))
+                single_duration = time.perf_counter() - start
+                start = time.perf_counter()
+                await bot.token_actions(FakeRoom(), FakeEvent("create all 2"))
+                batch_duration = time.perf_counter() - start
+            finally:
+                await asyncio.gather(*[target_api.close() for target_api in bot.apis.values()])
+            return replies, single_duration, batch_duration
+
+    replies, single_duration, batch_duration = asyncio.run(scenario())
+    assert len(first.tokens) == 3 and len(second.tokens) == 3
+    assert [reply.split("\n")[0] for reply in replies if reply.startswith("**")] == ["**one**", "**two**"] * 2
+    assert single_duration < 0.35 and batch_duration < 0.35
+
+
+def test_bot_credentials_only_for_bot_homeserver():
+    bot_config = {"server": "https://Matrix.example.com/", "username": "registration-bot", "password": "secret"}
+    own_api = bot.create_api({"base_url": "https://matrix.example.com", "token_store": ""}, bot_config)
+    assert own_api.username == "registration-bot"
+    with pytest.raises(KeyError, match="matrix.example.org"):
+        bot.create_api({"base_url": "https://matrix.example.org", "token_store": ""}, bot_config)
+
+
+def test_reload_waits_for_background_jobs(monkeypatch, tmp_path):
+    fake = FakeSynapse([make_token("used", completed=1), make_token("valid")], latency=0.1)
+
+    async def scenario():
+        async with fake.server() as server:
+            homeservers = [{"base_url": str(server.make_url("")), "token": fake.access_token}]
+            setup_bot(monkeypatch, tmp_path, homeservers)
+            old_api = bot.api
+            purge = asyncio.create_task(bot.purge_tokens_periodically(3600, dry_run=False))
+            try:
+                await asyncio.sleep(0.05)
+                homeservers[0]["max_retries"] = 1
+                config_path = tmp_path / "config.yml"
+                changed_config = yaml.safe_load(config_path.read_text())
+                changed_config["homeservers"] = homeservers
+                config_path.write_text(yaml.safe_dump(changed_config))
+                assert bot.reload_config() and bot.api is not old_api
+                await asyncio.wait_for(asyncio.gather(*bot.closing_tasks), 5)
+            finally:
+                purge.cancel()
+                await bot.api.close()
+            return old_api
+
+    old_api = asyncio.run(scenario())
+    assert list(fake.tokens) == ["valid"]
+    assert old_api.session is None and not bot.replaced_apis
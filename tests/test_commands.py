@@ -0,0 +1,14 @@
+import asyncio
+import simplematrixbotlib
+from matrix_registration_bot import bot
+from tests.fake_synapse import FakeEvent, FakeRoom
+
+
+def test_prefilter_drops_messages_that_are_no_command(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("The message was parsed")
+
+    monkeypatch.setattr(simplematrixbotlib, "MessageMatch", fail)
+    monkeypatch.setattr(bot, "bot_prefix", "!")
+    for body in ["good morning", "!good morning", "!", "list"]:
+        asyncio.run(bot.token_actions(FakeRoom(), FakeEvent(body)))
@@ -0,0 +1,45 @@
+import asyncio
+import json
+import logging
+from matrix_registration_bot import logs
+
+
+def test_json_records_carry_the_request_id(capsys):
+    logs.configure_logging("debug", "json")
+    try:
+        async def command():
+            logs.request_id.set("abc123")
+            # Tasks started by a command inherit its ID
+            await asyncio.create_task(asyncio.sleep(0))
+            logging.getLogger("test").info("Deleted %s token(s)", 3)
+
+        asyncio.run(command())
+        logging.info("Outside of a command")
+        lines = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+        assert {"level": "INFO", "logger": "test", "request_id": "abc123", "message": "Deleted 3 token(s)"}.items() \
+            <= lines[-2].items()
+        assert lines[-1]["request_id"] == "-"
+    finally:
+        logs.configure_logging()
+
+
+def test_levels_are_applied_before_formatting():
+    logs.configure_logging("warning")
+    try:
+        class Expensive:
+            def __str__(self):
+                raise AssertionError("formatted although the level is disabled")
+
+        logging.info("%s", Expensive())
+        assert logging.getLogger().level == logging.WARNING
+    finally:
+        logs.configure_logging()
+
+
+def test_queue_handler_writes_in_background(capsys):
+    logs.configure_logging("info", use_queue=True)
+    try:
+        logging.info("Queued %s", "record")
+    finally:
+        logs.configure_logging()
+    assert "Queued record" in capsys.readouterr().err
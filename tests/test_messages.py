@@ -0,0 +1,75 @@
+import asyncio
+from matrix_registration_bot.messages import MAX_CONCURRENT_SENDS, MAX_MESSAGE_SIZE, chunk_lines, send_reply
+
+
+def test_chunk_lines_respects_max_size():
+    lines = (f"`token{i}`" for i in range(1000))
+    messages = list(chunk_lines(lines, max_size=100, separator=", "))
+    assert all(len(message.encode()) <= 100 for message in messages)
+    assert ", ".join(messages).split(", ") == [f"`token{i}`" for i in range(1000)]
+
+
+def test_chunk_lines_keeps_oversized_lines():
+    assert list(chunk_lines(["a" * 20, "b"], max_size=10)) == ["a" * 20, "b"]
+    assert list(chunk_lines([])) == []
+
+
+class FakeMatrixBot:
+    """Collects what send_reply sends instead of talking to a homeserver"""
+
+    def __init__(self, upload_works=True):
+        self.sent = []
+        self.upload_works = upload_works
+        self.api = self
+        self.async_client = self
+        self.config = type("Config", (), {"encryption_enabled": False, "ignore_unverified_devices": True})
+
+    async def send_markdown_message(self, room_id, message):
+        # Yields to the event loop like a real request, so concurrent replies compete for the send slots
+        await asyncio.sleep(0)
+        self.sent.append(("message", message))
+
+    async def upload(self, file, content_type, filename, filesize, encrypt):
+        self.sent.append(("upload", file.read().decode()))
+        return type("Response", (), {"content_uri": "mxc://example.com/file"} if self.upload_works else {})(), None
+
+    async def room_send(self, room_id, message_type, content, ignore_unverified_devices):
+        self.sent.append(("file", content["url"]))
+
+
+def test_small_replies_are_sent_as_messages_in_order():
+    matrix_bot = FakeMatrixBot()
+    lines = [f"line {i} " + "x" * 1000 for i in range(30)]
+    asyncio.run(send_reply(matrix_bot, "!room:example.com", lines, title="**Title**\n", code_block=True))
+    messages = [content for kind, content in matrix_bot.sent]
+    assert all(kind == "message" and len(content.encode()) <= MAX_MESSAGE_SIZE for kind, content in matrix_bot.sent)
+    assert messages[0].startswith("**Title**\n```\nline 0 ") and messages[1].startswith("```\nline ")
+    assert "\n".join(messages).count("line ") == 30
+
+
+def test_large_replies_are_uploaded_as_file():
+    matrix_bot = FakeMatrixBot()
+    lines = [f"token{i}" for i in range(20000)]
+    asyncio.run(send_reply(matrix_bot, "!room:example.com", lines, filename="tokens.txt"))
+    assert [kind for kind, content in matrix_bot.sent] == ["upload", "message", "file"]
+    assert matrix_bot.sent[0][1] == "\n".join(lines)
+
+
+def test_failed_uploads_fall_back_to_messages():
+    matrix_bot = FakeMatrixBot(upload_works=False)
+    lines = [f"token{i}" for i in range(20000)]
+    asyncio.run(send_reply(matrix_bot, "!room:example.com", lines))
+    assert "\n".join(content for kind, content in matrix_bot.sent if kind == "message") == "\n".join(lines)
+
+
+def test_concurrent_replies_in_several_event_loops():
+    matrix_bot = FakeMatrixBot()
+
+    async def replies():
+        await asyncio.gather(*[send_reply(matrix_bot, "!room:example.com", [f"reply {i}"])
+                               for i in range(2 * MAX_CONCURRENT_SENDS)])
+
+    # Each asyncio.run uses a new event loop, the limit of concurrent sends must not be bound to the first one
+    asyncio.run(replies())
+    asyncio.run(replies())
+    assert len(matrix_bot.sent) == 4 * MAX_CONCURRENT_SENDS
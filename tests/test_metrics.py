@@ -0,0 +1,36 @@
+from matrix_registration_bot.metrics import Counter, Histogram
+
+
+def test_counter_exposition():
+    counter = Counter("test_requests_total", "Requests", ["method", "status"])
+    counter.inc("GET", 200)
+    counter.inc("GET", 200)
+    counter.inc("DELETE", 404)
+    assert list(counter.expose()) == [
+        "# HELP test_requests_total Requests",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{method="DELETE",status="404"} 1',
+        'test_requests_total{method="GET",status="200"} 2',
+    ]
+
+
+def test_exposition_with_mixed_label_types():
+    counter = Counter("test_requests_total", "Requests", ["method", "status"])
+    counter.inc("GET", 200)
+    counter.inc("GET", "error")
+    counter.inc("GET", 200)
+    assert list(counter.expose())[2:] == [
+        'test_requests_total{method="GET",status="200"} 2',
+        'test_requests_total{method="GET",status="error"} 1',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_duration_seconds", "Duration", ["command"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe("list", value=value)
+    lines = list(histogram.expose())
+    assert 'test_duration_seconds_bucket{command="list",le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{command="list",le="1"} 3' in lines
+    assert 'test_duration_seconds_bucket{command="list",le="+Inf"} 4' in lines
+    assert 'test_duration_seconds_count{command="list"} 4' in lines
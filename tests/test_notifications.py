@@ -0,0 +1,72 @@
+import asyncio
+import time
+from matrix_registration_bot.notifications import TokenNotifier
+from tests.fake_synapse import FakeSynapse, make_token
+from tests.test_registration_api import run_with_fake_api
+
+
+def test_expiry_is_notified_when_due():
+    now = int(time.time() * 1000)
+    fake = FakeSynapse([make_token("soon", expiry_time=now + 300), make_token("later", expiry_time=now + 3600 * 1000),
+                        make_token("unlimited", uses_allowed=None)])
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def scenario(api):
+        notifier = TokenNotifier(api, send, expiry_warning=0.2)
+        task = asyncio.create_task(notifier.run())
+        await asyncio.sleep(0.5)
+        task.cancel()
+        return notifier
+
+    notifier = asyncio.run(run_with_fake_api(fake, scenario))
+    assert len(messages) == 2
+    assert messages[0].startswith("* Token `soon` expires at") and messages[1] == "* Token `soon` expired"
+    assert notifier.valid_tokens == 2
+    # No periodic polling: only the initial list was requested
+    assert fake.requests == [("GET", None)]
+
+
+def test_used_up_tokens_are_noticed_and_refilled():
+    fake = FakeSynapse([make_token("first"), make_token("second")])
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def scenario(api):
+        notifier = TokenNotifier(api, send, low_stock=2, refill=2)
+        task = asyncio.create_task(notifier.run())
+        await asyncio.sleep(0.05)
+        fake.tokens["first"]["completed"] = 1
+        await api.list_tokens(use_cache=False)
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    asyncio.run(run_with_fake_api(fake, scenario))
+    assert messages[0].startswith("* Token `first` is used up\n* Only 1 valid token(s) left\n* Created 1 token(s)")
+    assert len(messages) == 1 and len(fake.tokens) == 3
+
+
+def test_partial_index_does_not_trigger_refill():
+    fake = FakeSynapse([make_token(f"token{i}") for i in range(10)], failing_requests=1)
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def scenario(api):
+        notifier = TokenNotifier(api, send, refill=10, list_retry_interval=0.1)
+        task = asyncio.create_task(notifier.run())
+        await asyncio.sleep(0.02)
+        await api.get_token("token3")
+        await asyncio.sleep(0.02)
+        assert not notifier.index_complete and len(fake.tokens) == 10
+        await asyncio.sleep(0.15)
+        assert notifier.index_complete
+        task.cancel()
+
+    asyncio.run(run_with_fake_api(fake, scenario, max_retries=0))
+    assert len(fake.tokens) == 10 and messages == []
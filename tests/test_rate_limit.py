@@ -0,0 +1,21 @@
+from matrix_registration_bot.rate_limit import RateLimiter
+
+
+def test_burst_then_refill():
+    limiter = RateLimiter(rate=1, burst=2)
+    assert limiter.allow("@a:example.com", now=0) == (True, 0.0)
+    assert limiter.allow("@a:example.com", now=0) == (True, 0.0)
+    allowed, retry_in = limiter.allow("@a:example.com", now=0)
+    assert not allowed and retry_in == 1
+    # Other keys have their own bucket
+    assert limiter.allow("@b:example.com", now=0)[0]
+    assert limiter.allow("@a:example.com", now=1)[0]
+
+
+def test_full_buckets_are_dropped():
+    limiter = RateLimiter(rate=1, burst=2)
+    limiter.last_cleanup = 0
+    limiter.allow("@a:example.com", now=0)
+    limiter.allow("@b:example.com", now=59.5)
+    limiter.allow("@c:example.com", now=60)
+    assert set(limiter.buckets) == {"@b:example.com", "@c:example.com"}
@@ -1,5 +1,12 @@
+import asyncio
+import os
+import time
 import pytest
+from matrix_registration_bot import metrics
+from matrix_registration_bot.circuit_breaker import CircuitBreaker
 from matrix_registration_bot.registration_api import RegistrationAPI
+from matrix_registration_bot.token_store import TokenStore
+from tests.fake_synapse import FakeSynapse, make_token
 
 valid_tokens = ["TrwUI5zHm~Gn3M9Am", "gpWrPaFrbuP73A6N", "dada", "a", "1", "J_2NGPksUSbST1cp",
                 "uERKLWlzIDhrVxQCSGLSmBdMEnKnnaOCNBUawgLgUyjjqnaIBFmMkJQATTpqhbXX"]
@@ -14,3 +21,212 @@ def test_valid_token_format():
     for token in invalid_tokens:
         if RegistrationAPI.valid_token_format(token):
             raise AssertionError(f"Falsely said {token} is a valid token")
+
+
+async def run_with_fake_api(fake, coroutine_function, **kwargs):
+    async with fake.server() as server:
+        api = RegistrationAPI(str(server.make_url("")), api_token="secret", **kwargs)
+        try:
+            return await coroutine_function(api)
+        finally:
+            await api.close()
+
+
+def test_delete_all_token_reuses_listed_details():
+    fake = FakeSynapse([make_token(f"token{i}") for i in range(25)])
+    deleted, failed = asyncio.run(run_with_fake_api(fake, lambda api: api.delete_all_token(), max_concurrency=4))
+    assert len(deleted) == 25
+    assert failed == []
+    assert fake.tokens == {}
+    # One list request and one DELETE per token, no additional lookups
+    assert [method for method, token in fake.requests].count("GET") == 1
+
+
+def test_delete_tokens_reports_failures():
+    fake = FakeSynapse([make_token("existing")])
+    deleted, failed = asyncio.run(run_with_fake_api(
+        fake, lambda api: api.delete_tokens(["existing", "missing", "in/valid"])))
+    assert [token["token"] for token in deleted] == ["existing"]
+    assert [token for token, error in failed] == ["missing", "in/valid"]
+    assert isinstance(failed[0][1], FileNotFoundError)
+    assert isinstance(failed[1][1], ValueError)
+
+
+def test_create_tokens_retries_rate_limited_requests():
+    fake = FakeSynapse([], rate_limited_requests=3)
+    created, errors = asyncio.run(run_with_fake_api(
+        fake, lambda api: api.create_tokens(20, uses_allowed=2, prefix="workshop-", length=8)))
+    assert errors == []
+    assert len(created) == 20
+    assert len(fake.tokens) == 20
+    for token in created:
+        assert token["token"].startswith("workshop-") and len(token["token"]) == 17
+        assert token["uses_allowed"] == 2
+    assert [method for method, token in fake.requests].count("POST") == 23
+
+
+def test_long_rate_limits_are_reported_instead_of_waited_for():
+    fake = FakeSynapse([], rate_limited_requests=1, retry_after_ms=3600 * 1000)
+    with pytest.raises(ConnectionError, match="wait 3600s"):
+        asyncio.run(run_with_fake_api(fake, lambda api: api.create_token()))
+    assert len(fake.requests) == 1
+
+
+def test_token_index_serves_reads_and_is_updated_on_writes():
+    fake = FakeSynapse([make_token(f"token{i}") for i in range(5)])
+
+    async def scenario(api):
+        await api.list_tokens()
+        for i in range(5):
+            await api.get_token(f"token{i}")
+        created = await api.create_token()
+        await api.delete_token("token0")
+        return created, await api.list_tokens()
+
+    created, token_list = asyncio.run(run_with_fake_api(fake, scenario))
+    assert sorted(token["token"] for token in token_list) == sorted(fake.tokens)
+    assert created["token"] in fake.tokens
+    # Only the initial list request reached the server, all lookups were served by the index
+    assert [method for method, token in fake.requests] == ["GET", "POST", "DELETE"]
+
+
+def test_failed_delete_invalidates_token_index():
+    fake = FakeSynapse([make_token("token0"), make_token("token1")])
+
+    async def scenario(api):
+        await api.list_tokens()
+        fake.failing_requests = 1
+        with pytest.raises(ConnectionError):
+            await api.delete_token("token0")
+        return await api.list_tokens()
+
+    token_list = asyncio.run(run_with_fake_api(fake, scenario, max_retries=0))
+    assert sorted(token["token"] for token in token_list) == ["token0", "token1"]
+    assert [method for method, token in fake.requests] == ["GET", "DELETE", "GET"]
+
+
+def test_token_index_expires():
+    fake = FakeSynapse([make_token("token")])
+
+    async def scenario(api):
+        await api.list_tokens()
+        await api.list_tokens()
+
+    asyncio.run(run_with_fake_api(fake, scenario, cache_ttl=0))
+    assert [method for method, token in fake.requests] == ["GET", "GET"]
+
+
+def test_idempotent_requests_are_retried_on_server_errors():
+    fake = FakeSynapse([make_token("token")], failing_requests=2)
+
+    async def scenario(api):
+        api.max_backoff = 0.01
+        return await api.list_tokens()
+
+    token_list = asyncio.run(run_with_fake_api(fake, scenario))
+    assert [token["token"] for token in token_list] == ["token"]
+    assert len(fake.requests) == 3
+
+
+def test_circuit_breaker_fails_fast_while_server_is_down():
+    fake = FakeSynapse([make_token("token")], failing_requests=100)
+
+    async def scenario(api):
+        api.max_backoff = 0.01
+        with pytest.raises(ConnectionError):
+            await api.list_tokens()
+        assert api.circuit_breaker.state == CircuitBreaker.OPEN
+        requests_before = len(fake.requests)
+        with pytest.raises(ConnectionError):
+            await api.list_tokens()
+        assert len(fake.requests) == requests_before
+
+    asyncio.run(run_with_fake_api(fake, scenario, max_retries=10, circuit_failure_threshold=3))
+    assert len(fake.requests) == 3
+
+
+def test_cancelled_trial_request_does_not_block_the_circuit():
+    fake = FakeSynapse([make_token("token")], latency=0.05)
+
+    async def scenario(api):
+        api.circuit_breaker.record_failure()
+        assert api.circuit_breaker.state == CircuitBreaker.OPEN
+        await asyncio.sleep(0.02)
+        trial = asyncio.create_task(api.create_token())
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        assert len(await api.list_tokens()) == 1
+        assert api.circuit_breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(run_with_fake_api(fake, scenario, circuit_failure_threshold=1, circuit_reset_timeout=0.01))
+
+
+def test_token_state():
+    now = 1642807497388
+    token = make_token("token")
+    assert RegistrationAPI.token_state(token, now) == "valid"
+    assert RegistrationAPI.token_state(dict(token, expiry_time=now - 1), now) == "expired"
+    assert RegistrationAPI.token_state(dict(token, pending=1), now) == "used-up"
+    assert RegistrationAPI.token_state(dict(token, uses_allowed=None, completed=5), now) == "valid"
+
+
+def test_purge_tokens_deletes_only_dead_tokens():
+    now = int(time.time() * 1000)
+    fake = FakeSynapse([make_token("expired", expiry_time=now - 1000),
+                         make_token("completed", completed=1),
+                         make_token("pending", pending=1),
+                         make_token("valid")])
+
+    dry_run_tokens, _ = asyncio.run(run_with_fake_api(fake, lambda api: api.purge_tokens(dry_run=True)))
+    assert sorted(token["token"] for token in dry_run_tokens) == ["completed", "expired"]
+    assert len(fake.tokens) == 4
+
+    purged, failed = asyncio.run(run_with_fake_api(fake, lambda api: api.purge_tokens()))
+    assert failed == []
+    assert sorted(fake.tokens) == ["pending", "valid"]
+
+
+def test_identical_reads_share_one_request():
+    fake = FakeSynapse([make_token("token")], latency=0.05)
+
+    async def scenario(api):
+        return await asyncio.gather(*[api.list_tokens() for _ in range(5)], api.get_token("token"))
+
+    results = asyncio.run(run_with_fake_api(fake, scenario, cache_ttl=0))
+    assert all(token_list == [make_token("token")] for token_list in results[:5])
+    assert fake.requests == [("GET", None), ("GET", "token")]
+
+
+def test_login_token_is_stored_and_renewed_once_when_rejected(tmp_path):
+    fake = FakeSynapse([make_token("first")])
+    store = TokenStore(str(tmp_path / "api_token.json"))
+
+    async def scenario():
+        async with fake.server() as server:
+            base_url = str(server.make_url(""))
+            api = RegistrationAPI(base_url, username="admin", password="password", token_store=store)
+            await api.list_tokens()
+            await api.close()
+            # A restart reuses the stored token instead of logging in again
+            api = RegistrationAPI(base_url, username="admin", password="password", token_store=store)
+            await api.get_token("first")
+            assert fake.logins == 1
+            # The token is revoked, concurrent requests share one new login
+            fake.access_token = "renewed"
+            await asyncio.gather(*[api.get_token("first") for _ in range(5)], api.list_tokens(use_cache=False))
+            await api.close()
+
+    asyncio.run(scenario())
+    assert fake.logins == 2
+    assert list(store.read().values()) == ["renewed"]
+    assert os.stat(store.path).st_mode & 0o777 == 0o600
+
+
+def test_token_metrics_are_labelled_by_server():
+    RegistrationAPI("https://one.example.com").update_token_metrics([make_token("a"), make_token("b", completed=1)])
+    RegistrationAPI("https://two.example.com").update_token_metrics([make_token("c")])
+    assert metrics.tokens.values[("https://one.example.com", "total")] == 2
+    assert metrics.tokens.values[("https://one.example.com", "used-up")] == 1
+    assert metrics.tokens.values[("https://two.example.com", "total")] == 1
@@ -0,0 +1,31 @@
+from matrix_registration_bot.snapshots import SnapshotStore
+from tests.fake_synapse import make_token
+
+DAY = 24 * 3600 * 1000
+NOW = 1700000000000
+
+
+def test_only_changes_are_recorded():
+    store = SnapshotStore(":memory:")
+    tokens = [make_token("a", uses_allowed=5), make_token("b"), make_token("c", uses_allowed=None)]
+    assert store.record(tokens, now=NOW) == 3
+    assert store.record(tokens, now=NOW + 1000) == 0
+
+    tokens = [make_token("a", uses_allowed=5, completed=2), make_token("c", uses_allowed=None, completed=1)]
+    assert store.record(tokens, now=NOW + DAY) == 3
+    tokens[0]["completed"] = 3
+    assert store.record(tokens, now=NOW + DAY + 1000) == 1
+
+    assert store.registrations_per_day() == [("2023-11-15", 4)]
+    assert store.conversion_rates() == [("a", 3, 5), ("c", 1, None)]
+    assert store.connection.execute("SELECT count(*) FROM changes").fetchone()[0] == 7
+
+
+def test_nearly_exhausted():
+    store = SnapshotStore(":memory:")
+    store.record([make_token("last-use", uses_allowed=3, completed=2),
+                  make_token("plenty", uses_allowed=10),
+                  make_token("expiring", uses_allowed=None, expiry_time=NOW + 1000),
+                  make_token("expired", expiry_time=NOW - 1000),
+                  make_token("used-up", completed=1)], now=NOW)
+    assert [row[0] for row in store.nearly_exhausted(now=NOW)] == ["last-use", "expiring"]
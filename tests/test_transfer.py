@@ -0,0 +1,63 @@
+import asyncio
+import io
+import time
+import pytest
+from matrix_registration_bot.transfer import export_lines, read_tokens, write_export
+from tests.fake_synapse import FakeSynapse, make_token
+from tests.test_registration_api import run_with_fake_api
+
+
+@pytest.mark.parametrize("export_format", ["csv", "jsonl"])
+def test_export_round_trip(export_format):
+    tokens = [make_token("limited", uses_allowed=3, completed=1, expiry_time=1700000000000),
+              make_token("unlimited", uses_allowed=None)]
+    file = io.StringIO()
+    assert write_export(tokens, file, export_format) == 2
+    file.seek(0)
+    assert list(read_tokens(file, export_format)) == [
+        {"token": "limited", "uses_allowed": 3, "pending": 0, "completed": 1, "expiry_time": 1700000000000},
+        {"token": "unlimited", "uses_allowed": None, "pending": 0, "completed": 0, "expiry_time": None}]
+
+
+def test_csv_export_is_streamed():
+    lines = export_lines(iter([make_token("first")]), "csv")
+    assert next(lines) == "token,uses_allowed,pending,completed,expiry_time"
+    assert next(lines) == "first,1,0,0,"
+
+
+def test_invalid_tokens_are_rejected():
+    with pytest.raises(ValueError, match="Line 2"):
+        list(read_tokens(io.StringIO('{"token": "ok"}\n{"token": "not ok"}\n')))
+
+
+def test_import_skips_existing_and_expired_tokens():
+    now = int(time.time() * 1000)
+    fake = FakeSynapse([make_token("existing")])
+    token_list = [{"token": "existing", "uses_allowed": 1, "expiry_time": None},
+                  {"token": "expired", "uses_allowed": 1, "expiry_time": now - 1000},
+                  {"token": "new", "uses_allowed": 5, "expiry_time": now + 3600 * 1000},
+                  {"token": "unlimited", "uses_allowed": None, "expiry_time": None}]
+    progress = []
+    created, skipped, errors = asyncio.run(run_with_fake_api(
+        fake, lambda api: api.import_tokens(token_list, lambda *args: progress.append(args))))
+    assert [token["token"] for token in created] == ["new", "unlimited"]
+    assert skipped == ["existing", "expired"] and errors == []
+    assert fake.tokens["new"]["uses_allowed"] == 5 and fake.tokens["new"]["expiry_time"] == now + 3600 * 1000
+    assert progress[-1] == (2, 2)
+    # Importing again creates nothing
+    created, skipped, errors = asyncio.run(run_with_fake_api(fake, lambda api: api.import_tokens(token_list)))
+    assert created == [] and len(skipped) == 4
+
+
+def test_import_keeps_used_uses():
+    fake = FakeSynapse()
+    file = io.StringIO()
+    write_export([make_token("spent", completed=1), make_token("reserved", pending=1),
+                  make_token("partly", uses_allowed=5, pending=1, completed=2),
+                  make_token("unlimited", uses_allowed=None, completed=7)], file, "csv")
+    file.seek(0)
+    token_list = list(read_tokens(file, "csv"))
+    created, skipped, errors = asyncio.run(run_with_fake_api(fake, lambda api: api.import_tokens(token_list)))
+    assert skipped == ["spent", "reserved"] and errors == []
+    assert fake.tokens["partly"]["uses_allowed"] == 2
+    assert fake.tokens["unlimited"]["uses_allowed"] is None